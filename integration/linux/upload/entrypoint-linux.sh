@@ -36,9 +36,13 @@ batch=$(mktemp)
 find . -type f -printf '%P\n' > "${list}"
 chmod g+rw "${list}"
 
+# Upload the listing under a temporary name first, so that it is never
+# picked up half-written.
+trigger=$(basename "${list}")
 cat <<EOF >${batch}
 put -r * incoming/
-put -p ${list} incoming/triggers/
+put -p ${list} incoming/triggers/.${trigger}
+rename incoming/triggers/.${trigger} incoming/triggers/${trigger}
 EOF
 
 sftp -o StrictHostKeyChecking=no -b "$batch" "$PACKAGE_SERVER"
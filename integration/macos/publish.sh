@@ -40,9 +40,12 @@ batch=$(mktemp)
 find . -type f -print | sed "s|^\./||" > "${list}"
 chmod g+rw "${list}"
 
+# Upload the listing under a temporary name first, so that it is never
+# picked up half-written.
 cat <<EOF >${batch}
 put -r * incoming/
-put ${list} incoming/triggers/upload${key}.list
+put ${list} incoming/triggers/.upload${key}.list
+rename incoming/triggers/.upload${key}.list incoming/triggers/upload${key}.list
 EOF
 sftp -b "${batch}" uploader@"$PACKAGE_SERVER"
 
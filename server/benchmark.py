@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+"""Benchmark process_incoming.py against an in-process S3 stand-in.
+
+Synthetic generic, apt and rpm upload tarballs are processed with the
+S3 API served by moto.  Signing is either stubbed out or done by one of
+the process_incoming signers with a throwaway key in a temporary GnuPG
+home, so no real keys are needed.  For every stage the wall time,
+number of S3 requests, bytes transferred and peak RSS are reported.
+As moto runs in the same process, the peak RSS includes the objects it
+keeps in memory, i.e. everything uploaded to the bucket so far.
+
+The apt stage needs dpkg-deb and reprepro, the rpm stage needs
+rpmbuild, rpm and createrepo_c; stages whose tools are missing are
+skipped.
+"""
+
+from __future__ import annotations
+from typing import Any, Final, Self
+from collections.abc import Generator
+
+import collections
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import random
+import re
+import resource
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import textwrap
+import threading
+import time
+
+import boto3.session  # type: ignore [import-untyped]
+import click
+import moto
+
+import process_incoming as pi
+
+BUCKET = "benchmark"
+REGION: Final = "us-east-2"
+DIST = "bookworm"
+RPM_DIST = "el9"
+REQUIRED_TOOLS = {
+    "generic": [],
+    "apt": ["dpkg-deb", "reprepro"],
+    "rpm": ["rpmbuild", "rpm", "createrepo_c"],
+}
+
+logger = logging.getLogger("benchmark")
+
+
+class S3Stats:
+    """Counts S3 requests and bytes by listening to botocore events."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def attach(self, session: boto3.session.Session) -> None:
+        session.events.register("request-created.s3", self._on_request)
+        session.events.register("before-send.s3", self._on_send)
+        session.events.register("after-call.s3", self._on_response)
+
+    def snapshot(self) -> tuple[collections.Counter[str], int, int]:
+        with self._lock:
+            return (
+                collections.Counter(self.requests),
+                self.bytes_sent,
+                self.bytes_received,
+            )
+
+    def _on_request(self, operation_name: str, **kwargs: Any) -> None:
+        with self._lock:
+            self.requests[operation_name] += 1
+
+    def _on_send(self, request: Any, **kwargs: Any) -> None:
+        # Uploads are sent aws-chunked, with the payload size in a
+        # separate header.
+        headers = request.headers
+        size = int(
+            headers.get("X-Amz-Decoded-Content-Length")
+            or headers.get("Content-Length")
+            or 0,
+        )
+        with self._lock:
+            self.bytes_sent += size
+
+    def _on_response(self, http_response: Any, **kwargs: Any) -> None:
+        size = int(http_response.headers.get("content-length") or 0)
+        with self._lock:
+            self.bytes_received += size
+
+
+class RSSSampler:
+    """Tracks the peak resident set size of the process over a stage."""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.peak = 0
+
+    def __enter__(self) -> Self:
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, current_rss())
+
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is the peak so far, in KiB on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GiB"
+
+
+def stub_signing(*, gpg: bool) -> None:
+    """Replace signing steps of process_incoming with no-ops.
+
+    RPM re-signing is always stubbed out; gpg signatures only if *gpg*
+    is true.
+    """
+
+    def gpg_detach_sign(path: pathlib.Path) -> pathlib.Path:
+        asc_path = path.with_suffix(path.suffix + ".asc")
+        asc_path.write_text(
+            "-----BEGIN PGP SIGNATURE-----\n"
+            "benchmark\n"
+            "-----END PGP SIGNATURE-----\n",
+        )
+        return asc_path
+
+    subprocess_run = pi.subprocess_run
+
+    def run(
+        cmd: list[Any],
+        *args: Any,
+        **kwargs: Any,
+    ) -> subprocess.CompletedProcess[str]:
+        if cmd[:2] == ["rpm", "--resign"]:
+            return subprocess.CompletedProcess(cmd, 0)
+        return subprocess_run(cmd, *args, **kwargs)
+
+    distributions = pi.generate_reprepro_distributions
+
+    def generate_reprepro_distributions(cfg: pi.Config) -> str:
+        return re.sub(
+            r"^SignWith:.*\n", "", distributions(cfg), flags=re.MULTILINE
+        )
+
+    pi.subprocess_run = run
+    if gpg:
+        pi.gpg_detach_sign = gpg_detach_sign
+        pi.generate_reprepro_distributions = generate_reprepro_distributions
+
+
+@contextlib.contextmanager
+def signing_key(
+    gnupg_home: pathlib.Path,
+) -> Generator[str, None, None]:
+    """Generate an unprotected signing key and yield its fingerprint."""
+    gnupg_home.mkdir(mode=0o700)
+    os.environ["GNUPGHOME"] = str(gnupg_home)
+    subprocess.run(
+        [
+            "gpg",
+            "--batch",
+            "--pinentry-mode=loopback",
+            "--passphrase=",
+            "--quick-gen-key",
+            "Benchmark <benchmark@example.com>",
+            "ed25519",
+            "sign",
+            "never",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    listing = subprocess.run(
+        ["gpg", "--batch", "--with-colons", "--list-secret-keys"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    fingerprints = [
+        line.split(":")[9]
+        for line in listing.splitlines()
+        if line.startswith("fpr:")
+    ]
+    if not fingerprints:
+        raise RuntimeError("could not generate a test signing key")
+    try:
+        yield fingerprints[0]
+    finally:
+        subprocess.run(["gpgconf", "--kill", "gpg-agent"], check=False)
+
+
+def build_metadata(
+    repository: str,
+    name: str,
+    version: str,
+    slot: str,
+    n: int,
+    contents: dict[str, Any],
+    **extra: Any,
+) -> dict[str, Any]:
+    build_date = datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC)
+    build_date += datetime.timedelta(hours=n)
+    revision = build_date.strftime("%Y%m%d%H") + "~nightly"
+    return {
+        "repository": repository,
+        "name": name,
+        "version": version,
+        "version_slot": slot,
+        "version_details": pi.parse_version(version),
+        "revision": revision,
+        "architecture": "x86_64",
+        "channel": "nightly",
+        "build_date": build_date.isoformat(),
+        "publish_link_to_latest": True,
+        "contents": contents,
+        "tags": {},
+        **extra,
+    }
+
+
+def nightly_version(n: int) -> str:
+    sha = hashlib.sha1(str(n).encode()).hexdigest()[:8]
+    return f"6.0.dev{9000 + n}+d{20240101 + n}.g{sha}"
+
+
+def add_file(tf: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    tf.addfile(info, io.BytesIO(data))
+
+
+def make_generic_upload(
+    path: pathlib.Path,
+    n: int,
+    payload: bytes,
+) -> None:
+    version = nightly_version(n)
+    binary = f"gel-server-6-{version}"
+    archive = f"{binary}.tar.gz"
+    metadata = build_metadata(
+        "generic",
+        "gel-server",
+        version,
+        "6",
+        n,
+        {
+            binary: {
+                "type": "application/octet-stream",
+                "encoding": "identity",
+                "suffix": "",
+            },
+            archive: {
+                "type": "application/x-tar",
+                "encoding": "gzip",
+                "suffix": ".tar.gz",
+            },
+        },
+        target="linux-x86_64",
+    )
+    with tarfile.open(path, "w") as tf:
+        add_file(tf, "build-metadata.json", json.dumps(metadata).encode())
+        add_file(tf, binary, payload)
+        add_file(tf, archive, payload)
+
+
+def package_metadata(metadata: dict[str, Any]) -> str:
+    """Return the metadata metapkg embeds into built packages."""
+    keys = (
+        "name",
+        "version",
+        "version_slot",
+        "version_details",
+        "architecture",
+        "revision",
+        "build_date",
+    )
+    return json.dumps({k: metadata[k] for k in keys})
+
+
+def make_apt_upload(
+    path: pathlib.Path,
+    n: int,
+    payload: bytes,
+    work_dir: pathlib.Path,
+) -> None:
+    version = nightly_version(n)
+    pkgname = "gel-server-6"
+    metadata = build_metadata("apt", "gel-server", version, "6", n, {})
+    debver = f"{version}-{metadata['revision']}"
+    root = work_dir / f"deb-{n}"
+    (root / "DEBIAN").mkdir(parents=True)
+    share = root / "usr" / "share" / pkgname
+    share.mkdir(parents=True)
+    (share / "payload").write_bytes(payload)
+    (root / "DEBIAN" / "control").write_text(
+        textwrap.dedent(
+            f"""\
+            Package: {pkgname}
+            Version: {debver}
+            Architecture: amd64
+            Maintainer: Benchmark <benchmark@example.com>
+            Installed-Size: {len(payload) // 1024}
+            Description: Synthetic benchmark package
+            """,
+        )
+        + f"Metapkg-Metadata: {package_metadata(metadata)}\n",
+    )
+    deb = work_dir / f"{pkgname}_{debver}_amd64.deb"
+    subprocess.run(
+        ["dpkg-deb", "--build", "--root-owner-group", str(root), str(deb)],
+        check=True,
+        capture_output=True,
+    )
+    shutil.rmtree(root)
+
+    data = deb.read_bytes()
+    size = len(data)
+    changes = textwrap.dedent(
+        f"""\
+        Format: 1.8
+        Date: Mon, 01 Jan 2024 00:00:00 +0000
+        Source: {pkgname}
+        Binary: {pkgname}
+        Architecture: amd64
+        Version: {debver}
+        Distribution: {DIST}
+        Urgency: medium
+        Maintainer: Benchmark <benchmark@example.com>
+        Description:
+         {pkgname} - Synthetic benchmark package
+        Changes:
+         {pkgname} ({debver}) {DIST}; urgency=medium
+         .
+           * Benchmark upload.
+        Checksums-Sha1:
+         {hashlib.sha1(data).hexdigest()} {size} {deb.name}
+        Checksums-Sha256:
+         {hashlib.sha256(data).hexdigest()} {size} {deb.name}
+        Files:
+         {hashlib.md5(data).hexdigest()} {size} database optional {deb.name}
+        """,
+    )
+    metadata["contents"] = {
+        deb.name: {"type": "application/vnd.debian.binary-package"},
+    }
+    metadata["dist"] = DIST
+    with tarfile.open(path, "w") as tf:
+        add_file(tf, "build-metadata.json", json.dumps(metadata).encode())
+        add_file(tf, deb.name, data)
+        add_file(tf, f"{pkgname}_{debver}_amd64.changes", changes.encode())
+    deb.unlink()
+
+
+def make_rpm_upload(
+    path: pathlib.Path,
+    n: int,
+    payload: bytes,
+    work_dir: pathlib.Path,
+) -> None:
+    version = nightly_version(n)
+    pkgname = "gel-server-6"
+    metadata = build_metadata("rpm", "gel-server", version, "6", n, {})
+    topdir = work_dir / f"rpmbuild-{n}"
+    (topdir / "SOURCES").mkdir(parents=True)
+    (topdir / "SOURCES" / "payload").write_bytes(payload)
+    spec = topdir / f"{pkgname}.spec"
+    spec.write_text(
+        textwrap.dedent(
+            f"""\
+            Name: {pkgname}
+            Version: {version}
+            Release: {n}
+            Summary: Synthetic benchmark package
+            License: Apache-2.0
+            BuildArch: x86_64
+            Source0: payload
+
+            %description
+            Synthetic benchmark package.
+
+            %install
+            mkdir -p %{{buildroot}}/usr/share/{pkgname}
+            cp %{{SOURCE0}} %{{buildroot}}/usr/share/{pkgname}/payload
+
+            %files
+            /usr/share/{pkgname}/payload
+
+            %changelog
+            * Mon Jan 01 2024 Benchmark <benchmark@example.com> - {version}-{n}
+            """,
+        )
+        + f"- {package_metadata(metadata)}\n",
+    )
+    subprocess.run(
+        [
+            "rpmbuild",
+            "-bb",
+            f"--define=_topdir {topdir}",
+            "--define=__os_install_post %{nil}",
+            str(spec),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    (rpm,) = (topdir / "RPMS").glob("*/*.rpm")
+    metadata["contents"] = {rpm.name: {"type": "application/x-rpm"}}
+    metadata["dist"] = RPM_DIST
+    with tarfile.open(path, "w") as tf:
+        add_file(tf, "build-metadata.json", json.dumps(metadata).encode())
+        tf.add(rpm, arcname=rpm.name)
+    shutil.rmtree(topdir)
+
+
+def make_uploads(
+    repository: str,
+    count: int,
+    payload_size: int,
+    incoming_dir: pathlib.Path,
+    work_dir: pathlib.Path,
+) -> list[str]:
+    rng = random.Random(repository)
+    uploads = []
+    for n in range(count):
+        path = incoming_dir / f"{repository}-{n:04d}.tar"
+        payload = rng.randbytes(payload_size)
+        if repository == "generic":
+            make_generic_upload(path, n, payload)
+        elif repository == "apt":
+            make_apt_upload(path, n, payload, work_dir)
+        elif repository == "rpm":
+            make_rpm_upload(path, n, payload, work_dir)
+        uploads.append(str(path))
+    return uploads
+
+
+def make_config(signing_key: str, signer: str) -> pi.Config:
+    return pi.Config(
+        common=pi.CommonConfig(
+            signing_key=signing_key,
+            buckets={"default": BUCKET},
+            signer=signer,
+        ),
+        generic=pi.GenericConfig(),
+        apt=pi.APTConfig(
+            architectures=["amd64"],
+            components=["main"],
+            distributions=[
+                pi.DistroDescription(codename=DIST, name="Debian Bookworm"),
+            ],
+        ),
+        rpm=pi.RPMConfig(),
+    )
+
+
+def run_stage(
+    name: str,
+    cfg: pi.Config,
+    session: boto3.session.Session,
+    stats: S3Stats,
+    uploads: list[str],
+    local_dir: pathlib.Path,
+) -> dict[str, Any]:
+    requests_before, sent_before, received_before = stats.snapshot()
+    with RSSSampler() as rss:
+        started_at = time.perf_counter()
+        pi.process_uploads(cfg, session, uploads, local_dir)
+        wall_time = time.perf_counter() - started_at
+    requests, sent, received = stats.snapshot()
+    requests.subtract(requests_before)
+
+    return {
+        "stage": name,
+        "uploads": len(uploads),
+        "wall_time": wall_time,
+        "requests": sum(requests.values()),
+        "requests_by_operation": dict(+requests),
+        "bytes_sent": sent - sent_before,
+        "bytes_received": received - received_before,
+        "peak_rss": rss.peak,
+    }
+
+
+def print_results(results: list[dict[str, Any]]) -> None:
+    click.echo(
+        f"{'stage':<16} {'uploads':>7} {'wall':>8} {'requests':>8} "
+        f"{'sent':>10} {'received':>10} {'peak RSS':>10}",
+    )
+    for r in results:
+        click.echo(
+            f"{r['stage']:<16} {r['uploads']:>7} {r['wall_time']:>7.2f}s "
+            f"{r['requests']:>8} {format_size(r['bytes_sent']):>10} "
+            f"{format_size(r['bytes_received']):>10} "
+            f"{format_size(r['peak_rss']):>10}",
+        )
+        ops = sorted(
+            r["requests_by_operation"].items(),
+            key=lambda item: (-item[1], item[0]),
+        )
+        click.echo("    " + ", ".join(f"{op} {n}" for op, n in ops))
+    click.echo(
+        "peak RSS includes the in-memory S3 store of moto, which holds "
+        "everything uploaded so far",
+    )
+
+
+@click.command()
+@click.option(
+    "-r",
+    "--repository",
+    "repositories",
+    type=click.Choice(["generic", "apt", "rpm"]),
+    multiple=True,
+    help="Repository types to benchmark (default: all).",
+)
+@click.option(
+    "-n",
+    "--uploads",
+    type=int,
+    default=20,
+    show_default=True,
+    help="Number of uploads per repository type.",
+)
+@click.option(
+    "--payload-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Size of each synthetic artifact in KiB.",
+)
+@click.option(
+    "--json-output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Also write the results as JSON to this file.",
+)
+@click.option(
+    "--signer",
+    type=click.Choice(["stub", *pi.SIGNERS]),
+    default="stub",
+    show_default=True,
+    help="Signer to use; anything but stub signs with a throwaway key.",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Show processing logs.")
+def main(
+    repositories: tuple[str, ...],
+    uploads: int,
+    payload_size: int,
+    json_output: str | None,
+    signer: str,
+    verbose: bool,  # noqa: FBT001
+) -> None:
+    logging.basicConfig(format="%(message)s")
+    if not verbose:
+        pi.logger.setLevel(logging.WARNING)
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    stub_signing(gpg=signer == "stub")
+
+    results = []
+    with (
+        moto.mock_aws(),
+        tempfile.TemporaryDirectory(prefix="genrepo-bench") as td,
+        contextlib.ExitStack() as stack,
+    ):
+        session = boto3.session.Session(region_name=REGION)
+        stats = S3Stats()
+        stats.attach(session)
+        s3 = session.resource("s3")
+        s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": REGION},
+        )
+        s3.BucketWebsite(BUCKET).put(
+            WebsiteConfiguration={
+                "IndexDocument": {"Suffix": "index.html"},
+                "RoutingRules": [
+                    {
+                        "Condition": {"KeyPrefixEquals": "benchmark/"},
+                        "Redirect": {"ReplaceKeyPrefixWith": "archive/"},
+                    },
+                ],
+            },
+        )
+
+        incoming_dir = pathlib.Path(td) / "incoming"
+        local_dir = pathlib.Path(td) / "local"
+        work_dir = pathlib.Path(td) / "work"
+        for d in (incoming_dir, local_dir, work_dir):
+            d.mkdir()
+        os.chdir(incoming_dir)
+
+        if signer == "stub":
+            cfg = make_config("benchmark", "gpg")
+        else:
+            gnupg_home = pathlib.Path(td) / "gnupg"
+            cfg = make_config(
+                stack.enter_context(signing_key(gnupg_home)),
+                signer,
+            )
+
+        for repository in repositories or ("generic", "apt", "rpm"):
+            missing = [
+                tool
+                for tool in REQUIRED_TOOLS[repository]
+                if shutil.which(tool) is None
+            ]
+            if missing:
+                logger.warning(
+                    "skipping %s: %s not found",
+                    repository,
+                    ", ".join(missing),
+                )
+                continue
+
+            paths = make_uploads(
+                repository,
+                uploads,
+                payload_size * 1024,
+                incoming_dir,
+                work_dir,
+            )
+            # Process the first upload on its own, so that the cost of
+            # populating an empty repository is reported separately.
+            results.append(
+                run_stage(
+                    f"{repository} (cold)",
+                    cfg,
+                    session,
+                    stats,
+                    paths[:1],
+                    local_dir,
+                ),
+            )
+            if len(paths) > 1:
+                results.append(
+                    run_stage(
+                        repository,
+                        cfg,
+                        session,
+                        stats,
+                        paths[1:],
+                        local_dir,
+                    ),
+                )
+
+    print_results(results)
+    if json_output:
+        with open(json_output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
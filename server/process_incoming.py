@@ -1,34 +1,56 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-from typing import Any, cast
+from typing import IO, Any, ClassVar, NamedTuple, NotRequired, Self, cast
+from collections.abc import Callable, Generator, Iterable, Iterator
 from typing_extensions import TypedDict
 
+import abc
+import bz2
+import collections
+import concurrent.futures
 import contextlib
+import contextvars
+import copy
+import ctypes
 import datetime
+import errno
 import hashlib
 import fnmatch
 import functools
+import gzip
 import io
 import json
 import os
 import logging
+import lzma
 import mimetypes
 import pathlib
 import re
+import select
 import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
 import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
+import time
 import tomllib
+import uuid
+from xml.etree import ElementTree
 
 import boto3  # type: ignore [import-untyped]
+import boto3.s3.transfer  # type: ignore [import-untyped]
 import boto3.session  # type: ignore [import-untyped]
+import botocore.exceptions
 import click
 import filelock
-import semver
+import zstandard
 
+from debian import deb822
 from debian import debian_support
 
 import mypy_boto3_s3
@@ -40,6 +62,39 @@ CACHE = "Cache-Control:public, no-transform, max-age=315360000"
 NO_CACHE = "Cache-Control:no-store, no-cache, private, max-age=0"
 ARCHIVE = pathlib.Path("archive")
 DIST = pathlib.Path("dist")
+APT_POOL_GENERATION = pathlib.Path("apt") / ".pool-generation"
+S3_JOBS = 8
+SIGN_JOBS = 4
+UPLOAD_RETRIES = 3
+TRANSIENT_ERROR_CODES = frozenset(
+    {
+        "InternalError",
+        "RequestTimeout",
+        "ServiceUnavailable",
+        "SlowDown",
+        "Throttling",
+        "ThrottlingException",
+    },
+)
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DELETE_BATCH_SIZE = 1000  # DeleteObjects limit
+DIGEST_ALGORITHMS = ("sha256", "blake2b")
+SIDECAR_SUFFIXES = (".asc", ".sha256", ".blake2b", ".metadata.json")
+MAX_ROUTING_RULES = 50  # per S3 website configuration
+TRIGGER_DEBOUNCE = 5.0
+TRIGGER_MAX_DELAY = 60.0
+POLL_INTERVAL = 2.0
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# struct inotify_event, followed by a NUL-padded name of len bytes
+INOTIFY_EVENT = struct.Struct("iIII")
+DIGEST_CHUNK_SIZE = 1024 * 1024
+VERSION_CACHE_SIZE = 4096
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+# Compressed copies of JSON indexes, by compression and by file suffix.
+INDEX_COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+INDEX_CONTENT_ENCODINGS = {".gz": "gzip", ".zst": "zstd"}
 
 logging.basicConfig(format="%(message)s")
 logger = logging.getLogger("process_incoming")
@@ -49,10 +104,17 @@ logger.setLevel(logging.INFO)
 class CommonConfig(TypedDict):
     signing_key: str
     buckets: dict[str, str]
+    jobs: NotRequired[int]
+    index_compression: NotRequired[str]
+    trace_dir: NotRequired[str]
+    metrics_file: NotRequired[str]
+    signer: NotRequired[str]
+    defer_finalization: NotRequired[bool]
 
 
 class GenericConfig(TypedDict):
-    pass
+    full_rebuild: NotRequired[bool]
+    gc_dry_run: NotRequired[bool]
 
 
 class DistroDescription(TypedDict):
@@ -64,10 +126,11 @@ class APTConfig(TypedDict):
     architectures: list[str]
     components: list[str]
     distributions: list[DistroDescription]
+    mirror_pool: NotRequired[bool]
 
 
 class RPMConfig(TypedDict):
-    pass
+    sign_jobs: NotRequired[int]
 
 
 class Config(TypedDict):
@@ -90,6 +153,28 @@ class Version(TypedDict):
     metadata: dict[str, str]
 
 
+class ParsedVersion(NamedTuple):
+    """An immutable form of :class:`Version`, as cached by parse_version."""
+
+    major: int
+    minor: int | None
+    patch: int | None
+    prerelease: tuple[tuple[str, int], ...]
+    metadata: tuple[tuple[str, str], ...]
+
+    def to_dict(self) -> Version:
+        return Version(
+            major=self.major,
+            minor=self.minor,
+            patch=self.patch,
+            prerelease=[
+                Prerelease(phase=phase, number=number)
+                for phase, number in self.prerelease
+            ],
+            metadata=dict(self.metadata),
+        )
+
+
 slot_regexp = re.compile(
     r"^(\w+(?:-[a-zA-Z]*)*?)"
     + r"(?:-(\d+(?:-(?:alpha|beta|rc)\d+)?(?:-dev\d+)?))?$",
@@ -118,6 +203,122 @@ version_regexp = re.compile(
 )
 
 
+class Trace:
+    """Spans and counters recorded while processing a single tarball.
+
+    Spans are opened with span() and nest according to the context they
+    are opened in.  S3 request and byte counts are collected from the
+    botocore events of the clients passed to attach().
+    """
+
+    def __init__(self) -> None:
+        self.started_at = time.time()
+        self._origin = time.monotonic()
+        self._lock = threading.Lock()
+        self.spans: list[dict[str, Any]] = []
+        self.counters: collections.Counter[str] = collections.Counter()
+
+    def start_span(
+        self,
+        name: str,
+        parent: int | None,
+        attrs: dict[str, Any],
+    ) -> dict[str, Any]:
+        record = {
+            "name": name,
+            "parent": parent,
+            "start": time.monotonic() - self._origin,
+            "duration": None,
+            "thread": threading.current_thread().name,
+            **attrs,
+        }
+        with self._lock:
+            record["id"] = len(self.spans)
+            self.spans.append(record)
+        return record
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def attach(self, client: Any) -> Generator[None, None, None]:
+        events = client.meta.events
+        handlers: list[tuple[str, Callable[..., None]]] = [
+            ("request-created.s3", self._on_request),
+            ("before-send.s3", self._on_send),
+            ("after-call.s3", self._on_response),
+        ]
+        for event, handler in handlers:
+            events.register(event, handler, unique_id=f"{event}-{id(self)}")
+        try:
+            yield
+        finally:
+            for event, _ in handlers:
+                events.unregister(event, unique_id=f"{event}-{id(self)}")
+
+    def _on_request(self, operation_name: str, **kwargs: Any) -> None:
+        self.count(f"s3.requests.{operation_name}")
+
+    def _on_send(self, request: Any, **kwargs: Any) -> None:
+        # Uploads are sent aws-chunked, with the payload size in a
+        # separate header.
+        headers = request.headers
+        size = headers.get("X-Amz-Decoded-Content-Length") or headers.get(
+            "Content-Length",
+        )
+        self.count("s3.bytes_sent", int(size or 0))
+
+    def _on_response(self, http_response: Any, **kwargs: Any) -> None:
+        size = http_response.headers.get("content-length")
+        self.count("s3.bytes_received", int(size or 0))
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "current_trace",
+    default=None,
+)
+_current_span: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    "current_span",
+    default=None,
+)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs: Any) -> Generator[None, None, None]:
+    """Record the duration of the block in the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    record = trace.start_span(name, _current_span.get(), attrs)
+    token = _current_span.set(record["id"])
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        record["duration"] = time.monotonic() - started_at
+        _current_span.reset(token)
+
+
+def traced[**P, R](func: Callable[P, R]) -> Callable[P, R]:
+    """Record every call of *func* as a span."""
+
+    @functools.wraps(func)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        with span(func.__qualname__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def count(name: str, value: int = 1) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
 def subprocess_run(
     *args: Any,
     **kwargs: Any,
@@ -125,10 +326,18 @@ def subprocess_run(
     kw = dict(kwargs)
     if kw.get("stdout") is None and not kw.get("capture_output"):
         kw["stdout"] = sys.stderr
-    return subprocess.run(*args, **kw)
+    cmd = args[0] if args else kw["args"]
+    count("subprocess.calls")
+    with span("subprocess", command=str(cmd[0])):
+        return subprocess.run(*args, **kw)
 
 
 def parse_version(ver: str) -> Version:
+    return parse_version_cached(ver).to_dict()
+
+
+@functools.lru_cache(maxsize=VERSION_CACHE_SIZE)
+def parse_version_cached(ver: str) -> ParsedVersion:
     v = version_regexp.match(ver)
     if v is None:
         raise ValueError(f"cannot parse version: {ver}")
@@ -174,12 +383,12 @@ def parse_version(ver: str) -> Version:
 
     release = [int(r) for r in v.group("release").split(".")]
 
-    return Version(
+    return ParsedVersion(
         major=release[0],
         minor=release[1] if len(release) == 2 else None,
         patch=release[2] if len(release) == 3 else None,
-        prerelease=prerelease,
-        metadata=metadata,
+        prerelease=tuple((p["phase"], p["number"]) for p in prerelease),
+        metadata=tuple(metadata.items()),
     )
 
 
@@ -209,84 +418,486 @@ class Packages(TypedDict):
     packages: list[Package]
 
 
-PackageIndex = dict[tuple[str, str, str], Package]
+class PackageRecord:
+    """A compact in-memory form of an index :class:`Package` entry.
+
+    Strings that repeat across the entries of an index are interned and
+    the version key is parsed into a tuple that sorts in Debian version
+    order (see :func:`version_sort_key`) when first needed.
+    """
+
+    __slots__ = (
+        "_keys",
+        "_sort_key",
+        "architecture",
+        "basename",
+        "build_date",
+        "extra",
+        "installref",
+        "installrefs",
+        "name",
+        "revision",
+        "slot",
+        "tags",
+        "version",
+        "version_details",
+        "version_key",
+    )
+
+    # The order in which to_json() writes the fields.
+    JSON_KEYS: ClassVar[tuple[str, ...]] = (
+        "basename",
+        "name",
+        "slot",
+        "version",
+        "version_details",
+        "version_key",
+        "revision",
+        "build_date",
+        "tags",
+        "architecture",
+        "installref",
+        "installrefs",
+    )
+
+    def __init__(
+        self,
+        *,
+        basename: str,
+        name: str,
+        slot: str | None,
+        version: str,
+        version_details: Version,
+        version_key: str,
+        revision: str,
+        build_date: str,
+        tags: dict[str, str],
+        architecture: str,
+        installref: str,
+        installrefs: list[InstallRef],
+        extra: dict[str, Any] | None = None,
+    ) -> None:
+        self.basename = sys.intern(basename)
+        self.name = sys.intern(name)
+        self.slot = slot
+        self.version = version
+        self.version_details = version_details
+        self.version_key = version_key
+        self.revision = revision
+        self.build_date = build_date
+        self.tags = tags
+        self.architecture = sys.intern(architecture)
+        self.installref = installref
+        self.installrefs = installrefs
+        self.extra = extra
+        self._sort_key: tuple[int, ...] | None = None
+        self._keys: tuple[str, ...] | None = None
+
+    @property
+    def sort_key(self) -> tuple[int, ...]:
+        if self._sort_key is None:
+            self._sort_key = version_sort_key(self.version_key)
+        return self._sort_key
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> PackageRecord:
+        extra = {k: v for k, v in data.items() if k not in PACKAGE_FIELDS}
+        fields = data | cls._legacy_defaults(data)
+        record = cls(
+            basename=fields["basename"],
+            name=fields["name"],
+            slot=fields["slot"],
+            version=fields["version"],
+            version_details=fields["version_details"],
+            version_key=fields["version_key"],
+            revision=fields["revision"],
+            build_date=fields["build_date"],
+            tags=fields["tags"],
+            architecture=fields["architecture"],
+            installref=fields["installref"],
+            installrefs=fields["installrefs"],
+            extra=extra or None,
+        )
+        keys = tuple(data)
+        if keys[: len(cls.JSON_KEYS)] != cls.JSON_KEYS:
+            record._keys = keys
+        return record
+
+    @staticmethod
+    def _legacy_defaults(data: dict[str, Any]) -> dict[str, Any]:
+        """Return values for the fields missing from an index entry.
+
+        Entries published by older versions may lack some fields.
+        """
+        installref = data.get("installref")
+        installrefs = data.get("installrefs")
+        if installrefs is None:
+            installrefs = []
+            if installref is not None:
+                installrefs.append(
+                    InstallRef(
+                        ref=installref,
+                        type=None,
+                        encoding=None,
+                        verification={},
+                    ),
+                )
+        if installref is None:
+            installref = installrefs[0]["ref"] if installrefs else ""
+        defaults: dict[str, Any] = {
+            "slot": None,
+            "revision": "",
+            "build_date": "1970-01-01T00:00:00+00:00",
+            "tags": {},
+            "installref": installref,
+            "installrefs": installrefs,
+        }
+        return {k: v for k, v in defaults.items() if k not in data}
+
+    def to_json(self) -> Package:
+        pkg = Package(
+            basename=self.basename,
+            name=self.name,
+            slot=self.slot,
+            version=self.version,
+            version_details=self.version_details,
+            version_key=self.version_key,
+            revision=self.revision,
+            build_date=self.build_date,
+            tags=self.tags,
+            architecture=self.architecture,
+            installref=self.installref,
+            installrefs=self.installrefs,
+        )
+        if self.extra:
+            pkg.update(self.extra)  # type: ignore [typeddict-item]
+        if self._keys is None:
+            return pkg
+
+        # Write an entry loaded from an older index back the way it was
+        # read, adding only the missing fields that have since changed.
+        full: dict[str, Any] = dict(pkg)
+        out = {k: full[k] for k in self._keys}
+        for k, v in self._legacy_defaults(out).items():
+            if full[k] != v:
+                out[k] = full[k]
+        return cast(Package, out)
+
+
+PACKAGE_FIELDS = frozenset(Package.__annotations__)
 
+PackageIndex = dict[tuple[str, str, str], PackageRecord]
 
+
+@traced
 def gpg_detach_sign(path: pathlib.Path) -> pathlib.Path:
     logger.info("gpg_detach_sign: %s", path)
     proc = subprocess_run(
         ["gpg", "--yes", "--batch", "--detach-sign", "--armor", str(path)],
     )
     proc.check_returncode()
-    asc_path = path.with_suffix(path.suffix + ".asc")
+    asc_path = signature_path(path)
     assert asc_path.exists()
     return asc_path
 
 
-def sha256(path: pathlib.Path) -> pathlib.Path:
-    logger.info("sha256: %s", path)
-    with open(path, "rb") as bf:
-        hash = hashlib.sha256(bf.read())
-    out_path = path.with_suffix(path.suffix + ".sha256")
-    with open(out_path, "w") as f:
-        f.write(hash.hexdigest())
-        f.write("\n")
-    return out_path
+def signature_path(path: pathlib.Path) -> pathlib.Path:
+    return path.with_suffix(path.suffix + ".asc")
+
+
+class Signer(abc.ABC):
+    """Creates detached, ASCII-armored signatures of files."""
+
+    def sign(self, path: pathlib.Path) -> pathlib.Path:
+        return self.sign_many([path])[0]
 
+    @abc.abstractmethod
+    def sign_many(self, paths: list[pathlib.Path]) -> list[pathlib.Path]:
+        pass
 
-def blake2b(path: pathlib.Path) -> pathlib.Path:
-    logger.info("blake2b: %s", path)
-    with open(path, "rb") as bf:
-        hash = hashlib.blake2b(bf.read())
-    out_path = path.with_suffix(path.suffix + ".blake2b")
-    with open(out_path, "w") as f:
-        f.write(hash.hexdigest())
-        f.write("\n")
-    return out_path
+    def close(self) -> None:  # noqa: B027
+        pass
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+
+class SubprocessSigner(Signer):
+    """Signs files one at a time, with a new gpg process for each."""
+
+    def sign_many(self, paths: list[pathlib.Path]) -> list[pathlib.Path]:
+        return [gpg_detach_sign(path) for path in paths]
+
+
+class GPGAgentSigner(Signer):
+    """Signs batches of files concurrently against a warm gpg-agent.
+
+    The agent is started once and primed with a throwaway signature, so
+    that the signing key is loaded and unlocked before the first batch.
+    Signatures are then made by a pool of gpg processes that all talk
+    to the same agent.
+    """
+
+    def __init__(self, *, jobs: int = SIGN_JOBS) -> None:
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._warm = False
+        self._lock = threading.Lock()
+
+    def sign_many(self, paths: list[pathlib.Path]) -> list[pathlib.Path]:
+        self._warm_up()
+        started_at = time.monotonic()
+        futures = [
+            self._pool.submit(
+                contextvars.copy_context().run,
+                gpg_detach_sign,
+                path,
+            )
+            for path in paths
+        ]
+        signed = [future.result() for future in futures]
+        logger.info(
+            "signed %d file(s) in %.1fs",
+            len(signed),
+            time.monotonic() - started_at,
+        )
+        return signed
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def _warm_up(self) -> None:
+        with self._lock:
+            if self._warm:
+                return
+            subprocess_run(["gpgconf", "--launch", "gpg-agent"], check=True)
+            with tempfile.TemporaryDirectory(prefix="genrepo") as td:
+                path = pathlib.Path(td) / "warmup"
+                path.write_bytes(b"")
+                gpg_detach_sign(path)
+            self._warm = True
+
+
+SIGNERS: dict[str, type[Signer]] = {
+    "gpg": SubprocessSigner,
+    "gpg-agent": GPGAgentSigner,
+}
+
+
+def make_signer(cfg: Config) -> Signer:
+    name = cfg["common"].get("signer", "gpg")
+    try:
+        signer_cls = SIGNERS[name]
+    except KeyError:
+        raise ValueError(
+            f"invalid signer in config: {name!r}, expected one of: "
+            f"{', '.join(SIGNERS)}",
+        ) from None
+    return signer_cls()
+
+
+def digest(
+    path: pathlib.Path,
+    algorithms: tuple[str, ...] = DIGEST_ALGORITHMS,
+) -> dict[str, str]:
+    """Compute all requested digests of *path* in a single read pass."""
+    logger.info("%s: %s", "+".join(algorithms), path)
+    with open(path, "rb", buffering=0) as bf:
+        return digest_stream(bf, algorithms)
+
+
+def digest_stream(
+    src: io.RawIOBase | io.BufferedIOBase,
+    algorithms: tuple[str, ...] = DIGEST_ALGORITHMS,
+    *,
+    copy_to: IO[bytes] | None = None,
+) -> dict[str, str]:
+    """Hash everything read from *src*, optionally copying it to *copy_to*.
+
+    The data is read into a single buffer that is reused for every chunk.
+    """
+    hashes = {alg: hashlib.new(alg) for alg in algorithms}
+    buf = memoryview(bytearray(DIGEST_CHUNK_SIZE))
+    while n := src.readinto(buf):
+        chunk = buf[:n]
+        if copy_to is not None:
+            copy_to.write(chunk)
+        for h in hashes.values():
+            h.update(chunk)
+    return {alg: h.hexdigest() for alg, h in hashes.items()}
+
+
+def extract_with_digests(
+    tf: tarfile.TarFile,
+    member: tarfile.TarInfo,
+    dest: pathlib.Path,
+    algorithms: tuple[str, ...] = DIGEST_ALGORITHMS,
+) -> dict[str, str]:
+    """Extract *member* into *dest* and digest it in the same pass.
+
+    This is equivalent to tf.extract(member, dest, filter="data")
+    followed by digest(), but reads the data only once.
+    """
+    member = tarfile.data_filter(member, str(dest))
+    path = dest / member.name
+    if not member.isreg():
+        tf.extract(member, dest, filter="data")
+        return digest(path, algorithms)
+
+    logger.info("extract+%s: %s", "+".join(algorithms), path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    src = tf.extractfile(member)
+    assert isinstance(src, io.BufferedReader)
+    with src, open(path, "wb") as dst:
+        digests = digest_stream(src, algorithms, copy_to=dst)
+    if member.mode is not None:
+        os.chmod(path, member.mode)
+    os.utime(path, (member.mtime, member.mtime))
+    return digests
+
+
+def write_digest_files(
+    path: pathlib.Path,
+    digests: dict[str, str],
+) -> list[pathlib.Path]:
+    """Write a <path>.<algorithm> sidecar file for each digest."""
+    out_paths = []
+    for alg, hexdigest in digests.items():
+        out_path = path.with_suffix(f"{path.suffix}.{alg}")
+        with open(out_path, "w") as f:
+            f.write(hexdigest)
+            f.write("\n")
+        out_paths.append(out_path)
+    return out_paths
 
 
 def format_version_key(ver: Version, revision: str) -> str:
+    return _format_version_key(
+        ver["major"],
+        ver["minor"],
+        ver["patch"],
+        tuple((pre["phase"], pre["number"]) for pre in ver["prerelease"]),
+        revision,
+    )
+
+
+@functools.lru_cache(maxsize=VERSION_CACHE_SIZE)
+def _format_version_key(
+    major: int,
+    minor: int | None,
+    patch: int | None,
+    prerelease: tuple[tuple[str, int], ...],
+    revision: str,
+) -> str:
     ver_components = []
-    for v in (ver["major"], ver["minor"], ver["patch"]):
+    for v in (major, minor, patch):
         if v is None:
             break
         ver_components.append(v)
     ver_key = ".".join(str(v) for v in ver_components)
-    if ver["prerelease"]:
+    if prerelease:
         # Using tilde for "dev" makes it sort _before_ the equivalent
         # version without "dev" when using the GNU version sort (sort -V)
         # or debian version comparison algorithm.
-        prerelease = (
-            ("~" if pre["phase"] == "dev" else ".")
-            + f"{pre['phase']}.{pre['number']}"
-            for pre in ver["prerelease"]
+        prerelease_parts = (
+            ("~" if phase == "dev" else ".") + f"{phase}.{number}"
+            for phase, number in prerelease
         )
-        ver_key += "~" + "".join(prerelease).lstrip(".~")
+        ver_key += "~" + "".join(prerelease_parts).lstrip(".~")
     if revision:
         ver_key += f".{revision}"
     return ver_key
 
 
+@functools.lru_cache(maxsize=VERSION_CACHE_SIZE)
+def version_sort_key(version_key: str) -> tuple[int, ...]:
+    """Return a key that sorts version strings in Debian version order.
+
+    Comparing keys is equivalent to comparing the versions themselves
+    with ``debian_support.version_compare()``.
+    """
+    ver = debian_support.Version(version_key)
+    return (
+        int(ver.epoch or 0),
+        *_dpkg_order(ver.upstream_version or ""),
+        *_dpkg_order(ver.debian_revision or "0"),
+    )
+
+
+def release_sort_key(ver: Version) -> tuple[Any, ...]:
+    """Return a key that sorts versions in SemVer precedence order."""
+    prerelease = tuple(
+        (pre["phase"], pre["number"]) for pre in ver["prerelease"]
+    )
+    # A release sorts after all of its pre-releases.
+    return (
+        ver["major"],
+        ver["minor"] or 0,
+        ver["patch"] or 0,
+        not prerelease,
+        prerelease,
+    )
+
+
+def _dpkg_order(part: str) -> list[int]:
+    # Alternating non-digit and digit runs as dpkg compares them: the
+    # characters of a non-digit run, where "~" sorts before the end of
+    # the run, which sorts before letters, which sort before anything
+    # else, followed by the numeric value of the digit run.  The last
+    # 0 marks the end of the string.
+    key = []
+    for chars, digits in re.findall(r"(\D*)(\d*)", part)[:-1]:
+        for c in chars:
+            if c == "~":
+                key.append(-1)
+            elif c.isalpha():
+                key.append(ord(c))
+            else:
+                key.append(ord(c) + 256)
+        key.extend((0, int(digits or 0)))
+    key.append(0)
+    return key
+
+
 def remove_old(
     bucket: s3.Bucket,
     prefix: pathlib.Path,
     keep: int,
     channel: str | None = None,
-) -> None:
+    *,
+    metadata_cache: MetadataCache | None = None,
+    dry_run: bool = False,
+) -> list[str]:
+    """Delete all but the *keep* latest versions of each artifact.
+
+    Outdated artifacts are deleted together with their sidecar files
+    in as few DeleteObjects requests as possible.  With *dry_run* the
+    deletions are only logged.
+
+    Returns the keys of the deleted artifacts.
+    """
     logger.info("remove_old: %s %s %s %s", bucket, prefix, keep, channel)
     index: dict[
         str,
         dict[
-            tuple[semver.Version, datetime.datetime],
+            tuple[tuple[Any, ...], datetime.datetime],
             list[str],
         ],
     ] = {}
     prefix_str = str(prefix) + "/"
-    for obj in bucket.objects.filter(Prefix=prefix_str):
+    listing = list_objects(bucket, prefix_str)
+    if metadata_cache is not None:
+        metadata_cache.prune(prefix_str, listing)
+    for obj in listing.values():
         if is_metadata_object(obj.key):
             continue
 
-        metadata = get_metadata(bucket, obj.key)
+        if metadata_cache is not None:
+            metadata = metadata_cache.get(bucket, obj.key, listing)
+        else:
+            metadata = get_metadata(bucket, obj.key)
         if metadata["channel"] != channel:
             continue
 
@@ -300,16 +911,7 @@ def remove_old(
         key = f"{key}-{catver}" if catver else f"{key}-{verslot}"
         key += f"-{metadata['architecture']}"
 
-        ver_details = metadata["version_details"]
-        version = semver.VersionInfo(
-            ver_details["major"],
-            ver_details["minor"],
-            ver_details["patch"] or 0,
-            ".".join(
-                f"{p['phase']}.{p['number']}"
-                for p in ver_details["prerelease"]
-            ),
-        )
+        version = release_sort_key(metadata["version_details"])
         build_date_str = metadata.get("build_date")
         if build_date_str:
             build_date = datetime.datetime.fromisoformat(build_date_str)
@@ -321,28 +923,52 @@ def remove_old(
         ver_key = (version, build_date)
         index.setdefault(key, {}).setdefault(ver_key, []).append(obj.key)
 
-    for _, versions in index.items():
+    deleted = []
+    to_delete = []
+    for versions in index.values():
         sorted_versions = sorted(versions, reverse=True)
         for ver in sorted_versions[keep:]:
             for obj_key in versions[ver]:
-                logger.info("Deleting outdated: %s", obj_key)
-                bucket.objects.filter(Prefix=obj_key).delete()
+                deleted.append(obj_key)
+                to_delete.append(obj_key)
+                to_delete.extend(
+                    f"{obj_key}{suffix}"
+                    for suffix in SIDECAR_SUFFIXES
+                    if f"{obj_key}{suffix}" in listing
+                )
+
+    if dry_run:
+        for key in to_delete:
+            logger.info("Would delete outdated: %s", key)
+        return []
+
+    for key in to_delete:
+        logger.info("Deleting outdated: %s", key)
+    delete_keys(bucket, to_delete)
+    if metadata_cache is not None:
+        metadata_cache.forget(deleted)
+
+    return deleted
 
 
 def describe_installref(
     bucket: s3.Bucket,
     obj: s3.ObjectSummary,
     metadata: dict[str, Any],
+    *,
+    digests: dict[str, str] | None = None,
 ) -> InstallRef:
     ref = obj.key
     if not ref.startswith("/"):
         ref = f"/{ref}"
 
-    verification: dict[str, str | int] = {
-        "size": obj.size,
-        "sha256": read(bucket, f"{obj.key}.sha256").decode("utf-8").rstrip(),
-        "blake2b": read(bucket, f"{obj.key}.blake2b").decode("utf-8").rstrip(),
-    }
+    if digests is None:
+        digests = get_recorded_digests(metadata)
+    if digests is None:
+        digests = read_digests(bucket, [obj.key])[obj.key]
+
+    verification: dict[str, str | int] = {"size": obj.size}
+    verification.update(digests)
 
     contents = metadata["contents"]
     desc = contents[pathlib.Path(obj.key).name]
@@ -367,8 +993,192 @@ def get_metadata(bucket: s3.Bucket, key: str) -> dict[str, Any]:
     return json.loads(data.decode("utf-8"))  # type: ignore [no-any-return]
 
 
+def get_recorded_digests(metadata: dict[str, Any]) -> dict[str, str] | None:
+    """Return artifact digests recorded in its .metadata.json, if any.
+
+    Artifacts uploaded before digests were recorded only have them in
+    the checksum sidecar files.
+    """
+    digests = metadata.get("digests")
+    if not digests or not all(alg in digests for alg in DIGEST_ALGORITHMS):
+        return None
+    return {alg: digests[alg] for alg in DIGEST_ALGORITHMS}
+
+
+def read_digests(
+    bucket: s3.Bucket,
+    keys: list[str],
+) -> dict[str, dict[str, str]]:
+    """Read the checksum sidecar files of *keys* concurrently."""
+    client = bucket.meta.client
+
+    def _read(key: str) -> str:
+        logger.info("read: %s", key)
+        body = client.get_object(Bucket=bucket.name, Key=key)["Body"]
+        return body.read().decode("utf-8").rstrip()
+
+    digests: dict[str, dict[str, str]] = {key: {} for key in keys}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_JOBS) as pool:
+        futures = {
+            (key, alg): pool.submit(_read, f"{key}.{alg}")
+            for key in keys
+            for alg in DIGEST_ALGORITHMS
+        }
+        for (key, alg), future in futures.items():
+            digests[key][alg] = future.result()
+
+    return digests
+
+
+def list_objects(
+    bucket: s3.Bucket,
+    prefix: str,
+) -> dict[str, s3.ObjectSummary]:
+    return {obj.key: obj for obj in bucket.objects.filter(Prefix=prefix)}
+
+
+class PersistentCache:
+    """A cache persisted as a JSON file in the local state directory.
+
+    With *keep_warm* set, as it is in daemon mode, open() keeps caches
+    in memory and hands out the same instance again for as long as its
+    file has not been modified by another process.
+    """
+
+    keep_warm: ClassVar[bool] = False
+    _instances: ClassVar[dict[pathlib.Path, PersistentCache]] = {}
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._path = path
+        self._mtime_ns: int | None = None
+
+    @classmethod
+    def open(cls, path: pathlib.Path) -> Self:
+        if not PersistentCache.keep_warm:
+            return cls(path)
+
+        cached = PersistentCache._instances.get(path)
+        if isinstance(cached, cls) and cached._mtime_ns == file_mtime_ns(path):
+            return cached
+
+        cache = cls(path)
+        PersistentCache._instances[path] = cache
+        return cache
+
+    def _update_mtime(self) -> None:
+        self._mtime_ns = file_mtime_ns(self._path)
+
+
+def file_mtime_ns(path: pathlib.Path) -> int | None:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class MetadataCache(PersistentCache):
+    """A persistent local cache of artifact .metadata.json contents.
+
+    Entries are keyed by artifact key and validated against the ETag of
+    the corresponding .metadata.json object in a bucket listing, so
+    metadata is only downloaded for objects that are new or have changed
+    since the last run.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        super().__init__(path)
+        self._entries: dict[str, tuple[str, dict[str, Any]]] = {}
+        self._dirty = False
+
+        if path.exists():
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except ValueError:
+                logger.warning("ignoring corrupt metadata cache: %s", path)
+            else:
+                for key, entry in data.get("entries", {}).items():
+                    self._entries[key] = (entry["etag"], entry["metadata"])
+            self._update_mtime()
+
+    @classmethod
+    def for_bucket(
+        cls,
+        local_dir: pathlib.Path,
+        bucket_name: str,
+    ) -> MetadataCache:
+        return cls.open(local_dir / ".metadata-cache" / f"{bucket_name}.json")
+
+    def get(
+        self,
+        bucket: s3.Bucket,
+        key: str,
+        listing: dict[str, s3.ObjectSummary],
+    ) -> dict[str, Any]:
+        metadata_obj = listing.get(f"{key}.metadata.json")
+        etag = metadata_obj.e_tag if metadata_obj is not None else None
+        entry = self._entries.get(key)
+        if etag is not None and entry is not None and entry[0] == etag:
+            return entry[1]
+
+        metadata = get_metadata(bucket, key)
+        if etag is not None:
+            self._entries[key] = (etag, metadata)
+            self._dirty = True
+        return metadata
+
+    def set_digests(self, key: str, digests: dict[str, str]) -> None:
+        """Remember sidecar digests of an artifact lacking recorded ones."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1]["digests"] = digests
+            self._dirty = True
+
+    def prune(
+        self,
+        prefix: str,
+        listing: dict[str, s3.ObjectSummary],
+    ) -> None:
+        """Forget entries under *prefix* that are no longer in *listing*."""
+        stale = [
+            key
+            for key in self._entries
+            if key.startswith(prefix) and key not in listing
+        ]
+        for key in stale:
+            del self._entries[key]
+        if stale:
+            self._dirty = True
+
+    def forget(self, keys: Iterable[str]) -> None:
+        """Drop the entries of *keys*, e.g. once they are deleted."""
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "entries": {
+                        key: {"etag": etag, "metadata": metadata}
+                        for key, (etag, metadata) in self._entries.items()
+                    },
+                },
+                f,
+            )
+        os.replace(tmp_path, self._path)
+        self._update_mtime()
+        self._dirty = False
+
+
 def append_artifact(
-    packages: dict[tuple[str, str, str], Package],
+    packages: PackageIndex,
     metadata: dict[str, Any],
     installref: InstallRef,
 ) -> None:
@@ -386,13 +1196,13 @@ def append_artifact(
     index_key = (metadata["name"], version_key, metadata["architecture"])
     prev_pkg = packages.get(index_key)
     if prev_pkg is not None:
-        for ref in prev_pkg["installrefs"]:
+        for ref in prev_pkg.installrefs:
             if ref["ref"] == installref["ref"]:
                 break
         else:
-            prev_pkg["installrefs"].append(installref)
+            prev_pkg.installrefs.append(installref)
     else:
-        pkg = Package(
+        pkg = PackageRecord(
             basename=basename,
             name="-".join(filter(None, (basename, slot))),
             slot=slot,
@@ -418,17 +1228,99 @@ def load_index(idxfile: pathlib.Path) -> PackageIndex:
     index: PackageIndex = {}
     if idxfile.exists():
         with open(idxfile) as f:
-            data = json.load(f)
-            if isinstance(data, dict) and (pkglist := data.get("packages")):
-                for pkg in pkglist:
-                    index_key = (
-                        pkg["basename"],
-                        pkg["version_key"],
-                        pkg["architecture"],
-                    )
-                    if "tags" not in pkg:
-                        pkg["tags"] = {}
-                    index[index_key] = Package(**pkg)  # type: ignore [typeddict-item]
+            index = parse_index(json.load(f))
+
+    return index
+
+
+def dump_index(packages: PackageIndex) -> Packages:
+    return Packages(packages=[pkg.to_json() for pkg in packages.values()])
+
+
+def iter_index_json(packages: PackageIndex) -> Iterator[str]:
+    """Serialize an index piecewise, exactly as json.dump(dump_index())."""
+    yield '{"packages": ['
+    for i, pkg in enumerate(packages.values()):
+        if i:
+            yield ", "
+        yield json.dumps(pkg.to_json())
+    yield "]}"
+
+
+def write_index(
+    path: pathlib.Path,
+    packages: PackageIndex,
+    *,
+    compression: str | None = None,
+) -> None:
+    """Atomically write a JSON package index to *path*.
+
+    With *compression* ("gzip" or "zstd"), a compressed copy is written
+    alongside, e.g. ``<dist>.json.gz``, otherwise stale copies are
+    removed.
+    """
+    siblings = {
+        c: path.with_name(path.name + suffix)
+        for c, suffix in INDEX_COMPRESSION_SUFFIXES.items()
+    }
+    with contextlib.ExitStack() as stack:
+        writers: list[IO[bytes] | io.BufferedIOBase] = [
+            stack.enter_context(atomic_write(path)),
+        ]
+        if compression is not None:
+            zf = stack.enter_context(atomic_write(siblings.pop(compression)))
+            if compression == "gzip":
+                writers.append(
+                    stack.enter_context(
+                        gzip.GzipFile(fileobj=zf, mode="wb", mtime=0),
+                    ),
+                )
+            elif compression == "zstd":
+                writers.append(
+                    stack.enter_context(
+                        zstandard.ZstdCompressor().stream_writer(
+                            zf,
+                            closefd=False,
+                        ),
+                    ),
+                )
+            else:
+                raise ValueError(f"unsupported compression: {compression}")
+
+        for chunk in iter_index_json(packages):
+            data = chunk.encode()
+            for w in writers:
+                w.write(data)
+
+    for stale in siblings.values():
+        stale.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def atomic_write(path: pathlib.Path) -> Generator[IO[bytes], None, None]:
+    """Write to a temporary file that replaces *path* on success."""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def parse_index(data: Any) -> PackageIndex:
+    index: PackageIndex = {}
+    if isinstance(data, dict) and (pkglist := data.get("packages")):
+        for pkg in pkglist:
+            index_key = (
+                pkg["basename"],
+                pkg["version_key"],
+                pkg["architecture"],
+            )
+            index[index_key] = PackageRecord.from_json(pkg)
 
     return index
 
@@ -437,10 +1329,17 @@ def make_generic_index(
     bucket: s3.Bucket,
     prefix: pathlib.Path,
     pkg_dir: str,
+    *,
+    metadata_cache: MetadataCache | None = None,
+    compression: str | None = None,
 ) -> None:
     logger.info("make_index: %s %s %s", bucket, prefix, pkg_dir)
-    packages: dict[tuple[str, str, str], Package] = {}
-    for obj in bucket.objects.filter(Prefix=str(prefix / pkg_dir)):
+    packages: PackageIndex = {}
+    listing = list_objects(bucket, str(prefix / pkg_dir))
+    if metadata_cache is not None:
+        metadata_cache.prune(f"{prefix / pkg_dir}/", listing)
+    artifacts = []
+    for obj in listing.values():
         path = pathlib.Path(obj.key)
         leaf = path.name
 
@@ -452,17 +1351,163 @@ def make_generic_index(
             logger.info(f"{leaf} is metadata")
             continue
 
-        metadata = get_metadata(bucket, obj.key)
-        installref = describe_installref(bucket, obj, metadata)
+        if metadata_cache is not None:
+            metadata = metadata_cache.get(bucket, obj.key, listing)
+        else:
+            metadata = get_metadata(bucket, obj.key)
+        artifacts.append((obj, metadata))
+
+    # Fetch checksums of artifacts that predate digests being recorded
+    # in their metadata in one concurrent batch.
+    legacy = [
+        obj.key
+        for obj, metadata in artifacts
+        if get_recorded_digests(metadata) is None
+    ]
+    legacy_digests = read_digests(bucket, legacy) if legacy else {}
+    if metadata_cache is not None:
+        for key, digests in legacy_digests.items():
+            metadata_cache.set_digests(key, digests)
+
+    for obj, metadata in artifacts:
+        installref = describe_installref(
+            bucket,
+            obj,
+            metadata,
+            digests=legacy_digests.get(obj.key),
+        )
+        append_artifact(packages, metadata, installref)
+
+    put_generic_index(
+        bucket,
+        prefix,
+        pkg_dir,
+        packages,
+        compression=compression,
+    )
+
+
+def update_generic_index(
+    bucket: s3.Bucket,
+    prefix: pathlib.Path,
+    pkg_dir: str,
+    *,
+    added: list[tuple[dict[str, Any], InstallRef]],
+    removed: list[str],
+    metadata_cache: MetadataCache | None = None,
+    compression: str | None = None,
+) -> None:
+    """Apply added and removed artifacts to the published generic index.
+
+    Falls back to a full make_generic_index() rebuild if there is no
+    published index to start from.
+    """
+    logger.info(
+        "update_index: %s %s %s (+%d, -%d)",
+        bucket,
+        prefix,
+        pkg_dir,
+        len(added),
+        len(removed),
+    )
+    index_obj_key = str(prefix / ".jsonindexes" / f"{pkg_dir}.json")
+    try:
+        packages = parse_index(json.loads(read(bucket, index_obj_key)))
+    except botocore.exceptions.ClientError as e:
+        if not is_not_found(e):
+            raise
+        logger.info("%s does not exist, rebuilding", index_obj_key)
+        make_generic_index(
+            bucket,
+            prefix,
+            pkg_dir,
+            metadata_cache=metadata_cache,
+            compression=compression,
+        )
+        return
+
+    # Re-uploaded artifacts are dropped and then re-added with their
+    # new verification data.  Artifacts that were added and removed
+    # again before the index got updated are left out entirely.
+    stale_refs = {f"/{key}" for key in removed}
+    added = [item for item in added if item[1]["ref"] not in stale_refs]
+    stale_refs.update(installref["ref"] for _, installref in added)
+    for index_key, pkg in list(packages.items()):
+        refs = [r for r in pkg.installrefs if r["ref"] not in stale_refs]
+        if not refs:
+            logger.info("removing %s (%s, %s) from JSON index", *index_key)
+            del packages[index_key]
+        elif len(refs) != len(pkg.installrefs):
+            pkg.installrefs = refs
+            if pkg.installref in stale_refs:
+                pkg.installref = refs[0]["ref"]
+
+    for metadata, installref in added:
         append_artifact(packages, metadata, installref)
 
-    index = Packages(packages=list(packages.values()))
-    source_bytes = json.dumps(index).encode("utf8")
+    put_generic_index(
+        bucket,
+        prefix,
+        pkg_dir,
+        packages,
+        compression=compression,
+    )
+
+
+def put_generic_index(
+    bucket: s3.Bucket,
+    prefix: pathlib.Path,
+    pkg_dir: str,
+    packages: PackageIndex,
+    *,
+    compression: str | None = None,
+) -> None:
     target_dir = prefix / ".jsonindexes"
     index_name = pkg_dir + ".json"
-    put(bucket, source_bytes, target_dir, name=index_name)
+    with tempfile.TemporaryDirectory() as td:
+        idxfile = pathlib.Path(td) / index_name
+        write_index(idxfile, packages, compression=compression)
+        for path in sorted(pathlib.Path(td).iterdir()):
+            put(
+                bucket,
+                path,
+                target_dir,
+                content_type="application/json",
+                content_encoding=INDEX_CONTENT_ENCODINGS.get(path.suffix, ""),
+            )
 
 
+def remove_stale_index_copies(
+    bucket: s3.Bucket,
+    prefix: pathlib.Path,
+    pkg_dirs: list[str],
+    *,
+    compression: str | None = None,
+) -> None:
+    """Delete compressed generic indexes that are no longer published.
+
+    These are left behind in the bucket when *compression* is changed
+    or turned off.
+    """
+    if not pkg_dirs:
+        return
+
+    current = INDEX_COMPRESSION_SUFFIXES.get(compression or "")
+    index_dir = f"{prefix / '.jsonindexes'}/"
+    listing = list_objects(bucket, index_dir)
+    stale = [
+        key
+        for pkg_dir in pkg_dirs
+        for suffix in INDEX_CONTENT_ENCODINGS
+        if suffix != current
+        and (key := f"{index_dir}{pkg_dir}.json{suffix}") in listing
+    ]
+    for key in stale:
+        logger.info("Deleting stale index: %s", key)
+    delete_keys(bucket, stale)
+
+
+@traced
 def put(
     bucket: s3.Bucket,
     source: pathlib.Path | bytes,
@@ -471,6 +1516,7 @@ def put(
     name: str = "",
     cache: bool = False,
     content_type: str = "",
+    content_encoding: str = "",
 ) -> s3.Object:
     ctx: contextlib.AbstractContextManager[Any]
 
@@ -482,10 +1528,10 @@ def put(
     else:
         ctx = contextlib.nullcontext(source)
 
-    if not content_type:
-        ct, _ = mimetypes.guess_type(name)
-        if ct is not None and "/" in ct:
-            content_type = ct
+    content_type = content_type or guess_content_type(name)
+    extra_args = {}
+    if content_encoding:
+        extra_args["ContentEncoding"] = content_encoding
     logger.info("put s3://%s/%s/%s", bucket.name, target, name)
     with ctx as body:
         result = bucket.put_object(
@@ -493,11 +1539,173 @@ def put(
             Body=body,
             CacheControl=CACHE if cache else NO_CACHE,
             ContentType=content_type,
+            **extra_args,  # type: ignore [arg-type]
         )
     logger.info(result)
     return result
 
 
+def guess_content_type(name: str) -> str:
+    ct, _ = mimetypes.guess_type(name)
+    if ct is not None and "/" in ct:
+        return ct
+    else:
+        return ""
+
+
+class UploadBatch:
+    """A queue of put() calls executed concurrently on flush().
+
+    Uploads are retried on transient errors and files larger than
+    *multipart_threshold* are sent as multipart uploads.
+    """
+
+    def __init__(
+        self,
+        bucket: s3.Bucket,
+        *,
+        jobs: int = S3_JOBS,
+        retries: int = UPLOAD_RETRIES,
+        multipart_threshold: int = MULTIPART_THRESHOLD,
+    ) -> None:
+        self._bucket = bucket
+        self._jobs = jobs
+        self._retries = retries
+        # Uploads already run *jobs* at a time, so don't let each of them
+        # fan out into another *jobs* threads for multipart parts.
+        self._transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            max_concurrency=1,
+        )
+        self._multipart_threshold = multipart_threshold
+        self._queue: dict[
+            str,
+            tuple[pathlib.Path | bytes, str, str, str, dict[str, str]],
+        ] = {}
+
+    def put(
+        self,
+        source: pathlib.Path | bytes,
+        target: pathlib.Path,  # directory
+        *,
+        name: str = "",
+        cache: bool = False,
+        cache_control: str = "",
+        content_type: str = "",
+        content_encoding: str = "",
+    ) -> None:
+        if isinstance(source, pathlib.Path):
+            name = name or source.name
+        elif not name:
+            raise ValueError(f"Name not given for target {target}")
+
+        if not cache_control:
+            cache_control = CACHE if cache else NO_CACHE
+
+        extra_args = {}
+        if content_encoding:
+            extra_args["ContentEncoding"] = content_encoding
+
+        key = str(target / name)
+        if key in self._queue:
+            raise ValueError(f"{key} is already queued for upload")
+
+        self._queue[key] = (
+            source,
+            key,
+            cache_control,
+            content_type or guess_content_type(name),
+            extra_args,
+        )
+
+    @traced
+    def flush(self) -> dict[str, str]:
+        """Upload everything queued and return the ETags of new objects."""
+        queue, self._queue = self._queue, {}
+        if not queue:
+            return {}
+
+        logger.info(
+            "uploading %d object(s) to s3://%s", len(queue), self._bucket.name
+        )
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs,
+        ) as pool:
+            futures = {
+                key: pool.submit(self._upload, *item)
+                for key, item in queue.items()
+            }
+            return {key: future.result() for key, future in futures.items()}
+
+    def _upload(
+        self,
+        source: pathlib.Path | bytes,
+        key: str,
+        cache_control: str,
+        content_type: str,
+        extra_args: dict[str, str],
+    ) -> str:
+        # Unlike resources, boto3 clients are safe to share between threads.
+        client = self._bucket.meta.client
+        for attempt in range(1, self._retries + 1):
+            try:
+                if (
+                    isinstance(source, pathlib.Path)
+                    and source.stat().st_size > self._multipart_threshold
+                ):
+                    client.upload_file(
+                        Filename=str(source),
+                        Bucket=self._bucket.name,
+                        Key=key,
+                        ExtraArgs={
+                            "CacheControl": cache_control,
+                            "ContentType": content_type,
+                            **extra_args,
+                        },
+                        Config=self._transfer_config,
+                    )
+                    etag = client.head_object(
+                        Bucket=self._bucket.name,
+                        Key=key,
+                    )["ETag"]
+                else:
+                    ctx: contextlib.AbstractContextManager[Any]
+                    if isinstance(source, pathlib.Path):
+                        ctx = open(source, "rb")  # noqa: SIM115
+                    else:
+                        ctx = contextlib.nullcontext(source)
+                    with ctx as body:
+                        etag = client.put_object(
+                            Bucket=self._bucket.name,
+                            Key=key,
+                            Body=body,
+                            CacheControl=cache_control,
+                            ContentType=content_type,
+                            **extra_args,  # type: ignore [arg-type]
+                        )["ETag"]
+            except (
+                botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+            ) as e:
+                if attempt == self._retries or not is_transient(e):
+                    raise
+                logger.warning(
+                    "put s3://%s/%s failed (attempt %d of %d): %s",
+                    self._bucket.name,
+                    key,
+                    attempt,
+                    self._retries,
+                    e,
+                )
+                time.sleep(2**attempt)
+            else:
+                logger.info("put s3://%s/%s", self._bucket.name, key)
+                return etag
+
+        raise AssertionError("unreachable")
+
+
+@traced
 def read(
     bucket: s3.Bucket,
     name: str,
@@ -507,6 +1715,154 @@ def read(
     return f.getvalue()
 
 
+class SyncManifest(PersistentCache):
+    """A record of local files as of their last transfer to or from S3.
+
+    For every file the manifest remembers its size and mtime together
+    with the ETag of the S3 object it was synced with.  A file whose
+    size and mtime still match its record is known to be identical to
+    the object with that ETag, which lets the sync functions skip it
+    without hashing or downloading anything.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        super().__init__(path)
+        self._files: dict[str, tuple[int, int, str]] = {}
+        self._dirty = False
+
+        if path.exists():
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except ValueError:
+                logger.warning("ignoring corrupt sync manifest: %s", path)
+            else:
+                for fn, (size, mtime_ns, etag) in data["files"].items():
+                    self._files[fn] = (size, mtime_ns, etag)
+            self._update_mtime()
+
+    def get_etag(self, path: pathlib.Path, st: os.stat_result) -> str | None:
+        """Return the ETag *path* was synced with if it is unchanged since."""
+        record = self._files.get(str(path))
+        if record is None:
+            return None
+        size, mtime_ns, etag = record
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        return etag
+
+    def record(self, path: pathlib.Path, etag: str) -> None:
+        st = path.stat()
+        self._files[str(path)] = (st.st_size, st.st_mtime_ns, etag)
+        self._dirty = True
+
+    def forget(self, path: pathlib.Path) -> None:
+        if self._files.pop(str(path), None) is not None:
+            self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+
+        tmp_path = self._path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self._files}, f)
+        os.replace(tmp_path, self._path)
+        self._update_mtime()
+        self._dirty = False
+
+
+def _sync_prefix(path: pathlib.Path) -> str:
+    return str(path).strip("/") + "/"
+
+
+def _sync_filter(
+    relpath: str,
+    include: str | None,
+    exclude: str | None,
+) -> bool:
+    # Same semantics as `aws s3 sync --exclude X --include Y`: later
+    # filters take precedence.
+    selected = True
+    if exclude and fnmatch.fnmatch(relpath, exclude):
+        selected = False
+    if include and fnmatch.fnmatch(relpath, include):
+        selected = True
+    return selected
+
+
+def list_sync_objects(
+    bucket: s3.Bucket,
+    prefix: str,
+) -> dict[str, s3.ObjectSummary]:
+    return {
+        obj.key[len(prefix) :]: obj
+        for obj in bucket.objects.filter(Prefix=prefix)
+        if not obj.key.endswith("/")
+    }
+
+
+def list_sync_files(root: pathlib.Path) -> dict[str, pathlib.Path]:
+    if not root.is_dir():
+        return {}
+    return {
+        path.relative_to(root).as_posix(): path
+        for path in root.rglob("*")
+        if path.is_file()
+    }
+
+
+def delete_keys(bucket: s3.Bucket, keys: list[str]) -> None:
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[i : i + DELETE_BATCH_SIZE]
+        result = bucket.delete_objects(
+            Delete={
+                "Objects": [{"Key": key} for key in batch],
+                "Quiet": True,
+            },
+        )
+        if errors := result.get("Errors"):
+            raise RuntimeError(
+                f"could not delete {len(errors)} object(s) from "
+                f"s3://{bucket.name}: {errors[:5]}",
+            )
+
+
+def is_not_found(e: botocore.exceptions.ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in {"404", "NoSuchKey"}
+
+
+def is_transient(
+    e: botocore.exceptions.BotoCoreError | botocore.exceptions.ClientError,
+) -> bool:
+    """Tell whether retrying the request that failed with *e* may help."""
+    if isinstance(e, botocore.exceptions.ClientError):
+        code = e.response.get("Error", {}).get("Code")
+        status = e.response.get("ResponseMetadata", {}).get(
+            "HTTPStatusCode",
+            0,
+        )
+        return code in TRANSIENT_ERROR_CODES or status == 429 or status >= 500
+    return isinstance(
+        e,
+        (
+            botocore.exceptions.ConnectionError,
+            botocore.exceptions.HTTPClientError,
+        ),
+    )
+
+
+def read_generation(bucket: s3.Bucket, key: pathlib.Path) -> str | None:
+    """Read a generation marker object, or None if there isn't one."""
+    try:
+        return read(bucket, str(key)).decode("utf-8").strip()
+    except botocore.exceptions.ClientError as e:
+        if not is_not_found(e):
+            raise
+        return None
+
+
+@traced
 def sync_to_local(
     bucket: s3.Bucket,
     source: pathlib.Path,
@@ -514,20 +1870,95 @@ def sync_to_local(
     *,
     delete: bool = True,
     exact_timestamps: bool = False,
-) -> None:
-    cmd = ["aws", "s3", "sync", "--no-progress"]
+    manifest: SyncManifest | None = None,
+) -> int:
+    """Mirror *source* in the bucket to *target*.
+
+    Returns the number of files downloaded or deleted.
+    """
+    prefix = _sync_prefix(source)
+    remote = list_sync_objects(bucket, prefix)
+    target.mkdir(parents=True, exist_ok=True)
+
+    fetch = []
+    for relpath, obj in remote.items():
+        path = target / relpath
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            fetch.append((path, obj))
+            continue
+
+        if st.st_size != obj.size:
+            fetch.append((path, obj))
+            continue
+
+        etag = manifest.get_etag(path, st) if manifest is not None else None
+        if etag is not None:
+            if etag != obj.e_tag:
+                fetch.append((path, obj))
+            continue
+
+        remote_mtime = obj.last_modified.timestamp()
+        if exact_timestamps:
+            changed = int(st.st_mtime) != int(remote_mtime)
+        else:
+            changed = remote_mtime > st.st_mtime
+        if changed:
+            fetch.append((path, obj))
+        elif manifest is not None:
+            manifest.record(path, obj.e_tag)
+
+    client = bucket.meta.client
+
+    def _download(path: pathlib.Path, obj: s3.ObjectSummary) -> None:
+        logger.info("download: s3://%s/%s", bucket.name, obj.key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.download")
+        client.download_file(
+            Bucket=bucket.name,
+            Key=obj.key,
+            Filename=str(tmp_path),
+        )
+        # Match the object's timestamp like `aws s3 sync` does.
+        mtime = obj.last_modified.timestamp()
+        os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_JOBS) as pool:
+        futures = {
+            path: (obj, pool.submit(_download, path, obj))
+            for path, obj in fetch
+        }
+        for path, (obj, future) in futures.items():
+            future.result()
+            if manifest is not None:
+                manifest.record(path, obj.e_tag)
+
+    deleted = 0
     if delete:
-        cmd.append("--delete")
-    if exact_timestamps:
-        cmd.append("--exact-timestamps")
-    src_path = str(source)
-    if not src_path.startswith("/"):
-        src_path = f"/{src_path}"
-    cmd.append(f"s3://{bucket.name}{src_path}")
-    cmd.append(str(target))
-    subprocess_run(cmd, check=True)
+        for relpath, path in list_sync_files(target).items():
+            if relpath not in remote:
+                logger.info("delete: %s", path)
+                path.unlink()
+                if manifest is not None:
+                    manifest.forget(path)
+                deleted += 1
+
+    logger.info(
+        "sync s3://%s/%s -> %s: %d downloaded, %d deleted, %d unchanged",
+        bucket.name,
+        prefix,
+        target,
+        len(fetch),
+        deleted,
+        len(remote) - len(fetch),
+    )
+
+    return len(fetch) + deleted
 
 
+@traced
 def sync_to_s3(
     bucket: s3.Bucket,
     source: pathlib.Path,
@@ -537,23 +1968,91 @@ def sync_to_s3(
     exclude: str | None = None,
     delete: bool = True,
     cache_control: str = "",
-) -> None:
-    cmd = ["aws", "s3", "sync", "--no-progress"]
+    content_encodings: dict[str, str] | None = None,
+    manifest: SyncManifest | None = None,
+) -> int:
+    """Mirror *source* to *target* in the bucket.
+
+    Files with a suffix listed in *content_encodings* are uploaded with
+    the corresponding Content-Encoding and the Content-Type of the file
+    name without that suffix.
+
+    Returns the number of objects uploaded or deleted.
+    """
+    prefix = _sync_prefix(target)
+    remote = list_sync_objects(bucket, prefix)
+    local = {
+        relpath: path
+        for relpath, path in list_sync_files(source).items()
+        if _sync_filter(relpath, include, exclude)
+    }
+
+    uploads = UploadBatch(bucket)
+    pending = {}
+    for relpath, path in local.items():
+        obj = remote.get(relpath)
+        st = path.stat()
+        if obj is not None and st.st_size == obj.size:
+            etag = (
+                manifest.get_etag(path, st) if manifest is not None else None
+            )
+            if etag is not None:
+                if etag == obj.e_tag:
+                    continue
+            elif st.st_mtime <= obj.last_modified.timestamp():
+                if manifest is not None:
+                    manifest.record(path, obj.e_tag)
+                continue
+
+        key = prefix + relpath
+        content_type = content_encoding = ""
+        if content_encodings and path.suffix in content_encodings:
+            content_encoding = content_encodings[path.suffix]
+            content_type = guess_content_type(path.stem)
+        uploads.put(
+            path,
+            pathlib.Path(key).parent,
+            cache_control=cache_control,
+            content_type=content_type,
+            content_encoding=content_encoding,
+        )
+        pending[key] = path
+
+    for key, etag in uploads.flush().items():
+        if manifest is not None:
+            manifest.record(pending[key], etag)
+
+    stale = []
     if delete:
-        cmd.append("--delete")
-    if cache_control:
-        cmd.extend(("--cache-control", cache_control))
-    if exclude:
-        cmd.extend(("--exclude", exclude))
-    if include:
-        cmd.extend(("--include", include))
-    tgt_path = str(target)
-    if not tgt_path.startswith("/"):
-        tgt_path = f"/{tgt_path}"
-    cmd.append(str(source))
-    cmd.append(f"s3://{bucket.name}{tgt_path}")
-    logger.info(" ".join(cmd))
-    subprocess_run(cmd, check=True)
+        stale = [
+            prefix + relpath
+            for relpath in remote
+            if relpath not in local and _sync_filter(relpath, include, exclude)
+        ]
+        for key in stale:
+            logger.info("delete: s3://%s/%s", bucket.name, key)
+        delete_keys(bucket, stale)
+
+    logger.info(
+        "sync %s -> s3://%s/%s: %d uploaded, %d deleted, %d unchanged",
+        source,
+        bucket.name,
+        prefix,
+        len(pending),
+        len(stale),
+        len(local) - len(pending),
+    )
+
+    return len(pending) + len(stale)
+
+
+class TarballReport(TypedDict):
+    path: str
+    repository: str | None
+    status: str
+    lock_wait: float
+    duration: float
+    trace: Trace
 
 
 @click.command()
@@ -561,14 +2060,85 @@ def sync_to_s3(
 @click.option("--bucket")
 @click.option("--incoming-dir")
 @click.option("--local-dir")
-@click.argument("upload_listing")  # a single file with a listing of many files
-def main(
-    config: str,
-    bucket: str | None,
-    incoming_dir: str,
-    local_dir: str,
-    upload_listing: str,
-) -> None:
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    help="Process tarballs for different repositories concurrently.",
+)
+@click.option(
+    "--full-rebuild",
+    is_flag=True,
+    help="Rebuild generic JSON indexes from scratch instead of updating.",
+)
+@click.option(
+    "--gc-dry-run",
+    is_flag=True,
+    help="Only log which outdated generic artifacts would be deleted.",
+)
+@click.option(
+    "--signer",
+    type=click.Choice(sorted(SIGNERS)),
+    help="Sign files one by one with gpg, or in batches via gpg-agent.",
+)
+@click.option(
+    "--defer-finalization",
+    is_flag=True,
+    help="Update indexes and sync to S3 once per listing, not per tarball.",
+)
+@click.option(
+    "--trace-dir",
+    help="Write a JSON trace of every processed tarball to this directory.",
+)
+@click.option(
+    "--metrics-file",
+    help="Write OpenMetrics text with timings and S3 usage to this file.",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Run as a daemon processing upload listings in incoming/triggers/.",
+)
+@click.option(
+    "--debounce",
+    type=float,
+    default=TRIGGER_DEBOUNCE,
+    show_default=True,
+    help="Seconds of quiet to wait for before processing new triggers.",
+)
+# a single file with a listing of many files
+@click.argument("upload_listing", required=False)
+def main(
+    config: str,
+    bucket: str | None,
+    incoming_dir: str,
+    local_dir: str,
+    jobs: int | None,
+    full_rebuild: bool,  # noqa: FBT001
+    gc_dry_run: bool,  # noqa: FBT001
+    signer: str | None,
+    defer_finalization: bool,  # noqa: FBT001
+    trace_dir: str | None,
+    metrics_file: str | None,
+    watch: bool,  # noqa: FBT001
+    debounce: float,
+    upload_listing: str | None,
+) -> None:
+    """Process the uploads in UPLOAD_LISTING, or watch for listings.
+
+    Clients upload a listing under a temporary dot-prefixed name and then
+    rename it into place, so dot-prefixed listings are ignored.  A
+    launcher that runs this once per listing must therefore trigger on
+    renames into the triggers directory (inotify IN_MOVED_TO), not only
+    on IN_CLOSE_WRITE.
+    """
+    if watch == (upload_listing is not None):
+        raise click.UsageError("pass either an upload listing or --watch")
+
+    if upload_listing and pathlib.Path(upload_listing).name.startswith("."):
+        logger.info("Ignoring incomplete upload listing: %s", upload_listing)
+        return
+
     with open(config, "rb") as cf:
         cfg = cast(Config, tomllib.load(cf))
         if "common" not in cfg:
@@ -579,105 +2149,889 @@ def main(
     if bucket:
         cfg["common"]["buckets"]["default"] = bucket
 
+    if jobs is not None:
+        cfg["common"]["jobs"] = jobs
+
+    if full_rebuild:
+        cfg.setdefault("generic", GenericConfig())["full_rebuild"] = True
+
+    if gc_dry_run:
+        cfg.setdefault("generic", GenericConfig())["gc_dry_run"] = True
+
+    if signer is not None:
+        cfg["common"]["signer"] = signer
+
+    if defer_finalization:
+        cfg["common"]["defer_finalization"] = True
+
+    if trace_dir is not None:
+        cfg["common"]["trace_dir"] = trace_dir
+
+    if metrics_file is not None:
+        cfg["common"]["metrics_file"] = metrics_file
+
     os.chdir(incoming_dir)
+    region = os.environ.get("AWS_REGION", "us-east-2")
+
+    if upload_listing is None:
+        session = boto3.session.Session(region_name=region)
+        watch_incoming(
+            cfg,
+            session,
+            pathlib.Path.cwd(),
+            pathlib.Path(local_dir),
+            debounce=debounce,
+        )
+        return
+
     with open(upload_listing) as upload_listing_file:
         uploads = upload_listing_file.read().splitlines()
     os.unlink(upload_listing)
 
-    region = os.environ.get("AWS_REGION", "us-east-2")
     session = boto3.session.Session(region_name=region)
-    s3: mypy_boto3_s3.S3ServiceResource = session.resource(
-        "s3",
-    )  # pyright: ignore [reportAssignmentType]
 
-    for path_str in uploads:
-        path = pathlib.Path(path_str)
-        if not path.is_file():
-            logger.info("File not found: %s", path)
-            continue
-        if path.suffix != ".tar":
-            logger.info("File is not a .tar archive: %s", path)
-            continue
+    process_uploads(
+        cfg,
+        session,
+        uploads,
+        pathlib.Path(local_dir),
+        defer_finalization=cfg["common"].get("defer_finalization", False),
+    )
+
+
+def watch_incoming(
+    cfg: Config,
+    session: boto3.session.Session,
+    incoming_dir: pathlib.Path,
+    local_dir: pathlib.Path,
+    *,
+    debounce: float = TRIGGER_DEBOUNCE,
+) -> None:
+    """Process upload listings as they appear in incoming/triggers/.
+
+    The boto3 session, the signer and the local caches are kept for the
+    lifetime of the daemon.  Triggers arriving in a burst are processed
+    as one batch, once no new files have shown up for *debounce*
+    seconds, so that the indexes of each repository are only rebuilt
+    once per burst.
+    """
+    triggers_dir = incoming_dir / "triggers"
+    triggers_dir.mkdir(exist_ok=True)
+    PersistentCache.keep_warm = True
+
+    stopping = threading.Event()
+    busy = False
+
+    def _terminate(signum: int, frame: Any) -> None:
+        # Finish the batch at hand rather than leave the repositories
+        # half-updated.
+        stopping.set()
+        if not busy:
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _terminate)
+
+    with (
+        make_signer(cfg) as signer,
+        DirectoryWatcher([triggers_dir, incoming_dir]) as watcher,
+    ):
+        logger.info("Watching %s for upload listings", triggers_dir)
+        while not stopping.is_set():
+            listings = list_triggers(triggers_dir)
+            if not listings:
+                watcher.wait(None)
+                continue
+            if not any(watcher.is_complete(p, debounce) for p in listings):
+                # Listings are still being uploaded.
+                watcher.wait(debounce)
+                continue
+
+            deadline = time.monotonic() + TRIGGER_MAX_DELAY
+            while time.monotonic() < deadline and watcher.wait(debounce):
+                pass
 
-        logger.info("Looking at: %s", path)
-        tmp_mgr = tempfile.TemporaryDirectory(prefix="genrepo", dir=local_dir)
+            busy = True
+            try:
+                uploads = read_triggers(triggers_dir, watcher, debounce)
+                if not uploads:
+                    continue
+                logger.info("Processing %d upload(s)", len(uploads))
+                process_uploads(
+                    cfg,
+                    session,
+                    uploads,
+                    local_dir,
+                    signer=signer,
+                    defer_finalization=True,
+                )
+            except Exception:
+                logger.exception("Processing of uploads failed")
+            finally:
+                busy = False
+
+
+def list_triggers(triggers_dir: pathlib.Path) -> list[pathlib.Path]:
+    """List the upload listings in *triggers_dir*, oldest first.
+
+    Dot files are skipped, so that clients can upload a listing under a
+    temporary name and rename it into place.
+    """
+    entries = sorted(
+        (
+            entry
+            for entry in os.scandir(triggers_dir)
+            if entry.is_file() and not entry.name.startswith(".")
+        ),
+        key=lambda entry: entry.stat().st_mtime_ns,
+    )
+    return [pathlib.Path(entry.path) for entry in entries]
+
+
+def read_triggers(
+    triggers_dir: pathlib.Path,
+    watcher: DirectoryWatcher,
+    min_age: float,
+) -> list[str]:
+    """Read and remove the upload listings in *triggers_dir*.
+
+    Listings that may still be being written, as far as *watcher* can
+    tell, are left for later.
+    """
+    uploads = []
+    for path in list_triggers(triggers_dir):
+        if not watcher.is_complete(path, min_age):
+            logger.info("Upload listing is incomplete, skipping: %s", path)
+            continue
+        with open(path) as f:
+            uploads.extend(f.read().splitlines())
+        os.unlink(path)
+        watcher.forget(path)
+    return uploads
+
+
+class DirectoryWatcher:
+    """Waits for files to be written to or moved into directories.
+
+    Uses inotify where it is available and falls back to comparing
+    directory listings every *poll_interval* seconds otherwise.
+    """
+
+    def __init__(
+        self,
+        paths: list[pathlib.Path],
+        *,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> None:
+        self._paths = paths
+        self._poll_interval = poll_interval
+        self._fd: int | None = None
+        self._watches: dict[int, pathlib.Path] = {}
+        # Files seen closed after writing or moved in, if using inotify.
+        self._written: set[pathlib.Path] = set()
+        self._preexisting = {pathlib.Path(entry[0]) for entry in self._scan()}
+        try:
+            self._fd, self._watches = inotify_watch(
+                paths,
+                IN_CLOSE_WRITE | IN_MOVED_TO,
+            )
+        except OSError as e:
+            logger.info("inotify is unavailable (%s), polling instead", e)
+        self._snapshot = self._scan() if self._fd is None else set()
+
+    def is_complete(self, path: pathlib.Path, min_age: float) -> bool:
+        """Tell whether *path* appears to be completely written.
+
+        With inotify, that is once it has been closed after writing or
+        moved into place.  Files that were already there when watching
+        started, or all files if polling, are taken to be complete once
+        they have not been modified for *min_age* seconds, which can be
+        wrong for writers stalling for longer than that.
+        """
+        if self._fd is not None:
+            if path in self._written:
+                return True
+            if path not in self._preexisting:
+                return False
         try:
-            with tarfile.open(path, "r:") as tf, tmp_mgr as temp_dir:
-                metadata_file = tf.extractfile("build-metadata.json")
-                if metadata_file is None:
-                    logger.info(
-                        "Tarball does not contain 'build-metadata.json': %s",
-                        path,
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - mtime >= min_age
+
+    def forget(self, path: pathlib.Path) -> None:
+        self._written.discard(path)
+        self._preexisting.discard(path)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def wait(self, timeout: float | None) -> bool:
+        """Wait up to *timeout* seconds for a change and report if any."""
+        if self._fd is not None:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                return False
+            with contextlib.suppress(BlockingIOError):
+                while buf := os.read(self._fd, 65536):
+                    self._read_events(buf)
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self._poll_interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+            snapshot = self._scan()
+            if snapshot != self._snapshot:
+                self._snapshot = snapshot
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def _read_events(self, buf: bytes) -> None:
+        offset = 0
+        while offset < len(buf):
+            wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(
+                buf,
+                offset,
+            )
+            offset += INOTIFY_EVENT.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+            directory = self._watches.get(wd)
+            if directory is not None and name:
+                self._written.add(directory / os.fsdecode(name))
+
+    def _scan(self) -> set[tuple[str, int, int]]:
+        entries = set()
+        for path in self._paths:
+            with (
+                contextlib.suppress(FileNotFoundError),
+                os.scandir(path) as it,
+            ):
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    entries.add((entry.path, st.st_size, st.st_mtime_ns))
+        return entries
+
+
+def inotify_watch(
+    paths: list[pathlib.Path],
+    mask: int,
+) -> tuple[int, dict[int, pathlib.Path]]:
+    """Watch *paths* for *mask* events with inotify.
+
+    Returns the inotify descriptor and the watched paths by watch
+    descriptor.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError(errno.ENOSYS, "inotify is not supported")
+
+    fd: int = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    watches = {}
+    for path in paths:
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err), str(path))
+        watches[wd] = path
+
+    return fd, watches
+
+
+def process_uploads(
+    cfg: Config,
+    session: boto3.session.Session,
+    uploads: list[str],
+    local_dir: pathlib.Path,
+    *,
+    signer: Signer | None = None,
+    defer_finalization: bool = False,
+) -> None:
+    """Process upload tarballs.
+
+    With *defer_finalization*, generic indexes and redirects are only
+    updated, and apt and rpm repositories only synced to S3, once all
+    tarballs are processed.  A *signer* is created
+    from the configuration unless one is given.
+    """
+    jobs = cfg["common"].get("jobs", 1)
+    reports: list[TarballReport] = []
+    finalizer = Finalizer() if defer_finalization else None
+    started_at = time.monotonic()
+    try:
+        with contextlib.ExitStack() as stack:
+            if signer is None:
+                signer = stack.enter_context(make_signer(cfg))
+            try:
+                if jobs <= 1:
+                    s3: mypy_boto3_s3.S3ServiceResource = session.resource(
+                        "s3",
+                    )  # pyright: ignore [reportAssignmentType]
+                    for path_str in uploads:
+                        report = process_upload(
+                            cfg,
+                            s3,
+                            path_str,
+                            local_dir,
+                            signer=signer,
+                            finalizer=finalizer,
+                        )
+                        if report is not None:
+                            reports.append(report)
+                else:
+                    process_uploads_concurrently(
+                        cfg,
+                        session,
+                        uploads,
+                        local_dir,
+                        jobs,
+                        reports,
+                        signer,
+                        finalizer,
                     )
-                    continue
+            finally:
+                # Whatever was published before a failure still has to
+                # make it into the indexes.
+                if finalizer is not None:
+                    finalize_uploads(
+                        cfg,
+                        session.resource("s3"),
+                        local_dir,
+                        finalizer,
+                        reports,
+                    )
+    finally:
+        log_timing_report(reports)
+        metrics_file = cfg["common"].get("metrics_file")
+        if metrics_file:
+            write_metrics(
+                pathlib.Path(metrics_file),
+                reports,
+                time.monotonic() - started_at,
+            )
 
-                metadata = json.loads(metadata_file.read())
-                repository = metadata.get("repository")
-
-                local_dir_path = pathlib.Path(local_dir)
-                temp_dir_path = pathlib.Path(temp_dir)
-                lock_path = local_dir_path / f"{repository}.lock"
-
-                tags = metadata.get("tags") or {}
-                tag_buckets = []
-
-                raw_tag_buckets = tags.get("buckets", "")
-                if raw_tag_buckets:
-                    tag_buckets = [
-                        bucket.strip() for bucket in raw_tag_buckets.split(",")
-                    ]
-
-                if not tag_buckets:
-                    tag_buckets = [tags.get("bucket", "default")]
-
-                logger.info(f"Obtaining {lock_path}")
-                with filelock.FileLock(lock_path, timeout=3600):
-                    for target_bucket in tag_buckets:
-                        bucket = cfg["common"]["buckets"].get(target_bucket)
-                        if bucket is None:
-                            raise RuntimeError(
-                                "invalid target bucket in metadata: "
-                                f"{target_bucket!r}, configure it in "
-                                "genrepo.toml",
-                            )
-
-                        if repository == "generic":
-                            process_generic(
-                                cfg,
-                                s3,
-                                tf,
-                                metadata,
-                                bucket,
-                                temp_dir_path,
-                                local_dir_path,
-                            )
-                        elif repository == "apt":
-                            process_apt(
-                                cfg,
-                                s3,
-                                tf,
-                                metadata,
-                                bucket,
-                                temp_dir_path,
-                                local_dir_path,
-                            )
-                        elif repository == "rpm":
-                            process_rpm(
-                                cfg,
-                                s3,
-                                tf,
-                                metadata,
-                                bucket,
-                                temp_dir_path,
-                                local_dir_path,
-                            )
-
-            logger.info("Successfully processed: %s", path)
-        finally:
-            with contextlib.suppress(PermissionError):
-                os.unlink(path)
 
+def finalize_uploads(
+    cfg: Config,
+    s3session: s3.S3ServiceResource,
+    local_dir: pathlib.Path,
+    finalizer: Finalizer,
+    reports: list[TarballReport],
+) -> None:
+    """Run *finalizer*, reported and traced like a tarball named finalize."""
+    started_at = time.monotonic()
+    report = TarballReport(
+        path="finalize",
+        repository="finalize",
+        status="failed",
+        lock_wait=0.0,
+        duration=0.0,
+        trace=Trace(),
+    )
+    reports.append(report)
+    trace_token = _current_trace.set(report["trace"])
+    try:
+        with contextlib.ExitStack() as stack:
+            clients = [s3session.meta.client, *finalizer.clients]
+            for client in clients:
+                stack.enter_context(report["trace"].attach(client))
+            with span("finalize"):
+                finalizer.finalize(cfg, s3session, local_dir)
+        report["status"] = "ok"
+    finally:
+        report["duration"] = time.monotonic() - started_at
+        _current_trace.reset(trace_token)
+        trace_dir = cfg["common"].get("trace_dir")
+        if trace_dir:
+            write_trace(pathlib.Path(trace_dir), report)
+
+
+def process_uploads_concurrently(
+    cfg: Config,
+    session: boto3.session.Session,
+    uploads: list[str],
+    local_dir: pathlib.Path,
+    jobs: int,
+    reports: list[TarballReport],
+    signer: Signer,
+    finalizer: Finalizer | None,
+) -> None:
+    # Tarballs going into the same repository contend for the same
+    # {repository}.lock anyway, so run each repository's queue serially
+    # in a single worker and let different repositories proceed in
+    # parallel.
+    queues: dict[str | None, list[str]] = {}
+    for path_str in uploads:
+        queues.setdefault(peek_repository(path_str), []).append(path_str)
+
+    def _drain(
+        s3: mypy_boto3_s3.S3ServiceResource,
+        queue: list[str],
+    ) -> None:
+        for path_str in queue:
+            report = process_upload(
+                cfg,
+                s3,
+                path_str,
+                local_dir,
+                signer=signer,
+                finalizer=finalizer,
+            )
+            if report is not None:
+                reports.append(report)
+
+    errors: list[BaseException] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for repository, queue in queues.items():
+            # boto3 resources are not thread-safe, so give each worker
+            # its own.
+            s3: mypy_boto3_s3.S3ServiceResource = session.resource(
+                "s3",
+            )  # pyright: ignore [reportAssignmentType]
+            futures[pool.submit(_drain, s3, queue)] = repository
+
+        for future in concurrent.futures.as_completed(futures):
+            exc = future.exception()
+            if exc is not None:
+                logger.error(
+                    "Processing of %s uploads failed: %s",
+                    futures[future],
+                    exc,
+                )
+                errors.append(exc)
+
+    if errors:
+        raise errors[0]
+
+
+def peek_repository(path_str: str) -> str | None:
+    path = pathlib.Path(path_str)
+    if not path.is_file() or path.suffix != ".tar":
+        return None
+    try:
+        with tarfile.open(path, "r:") as tf:
+            metadata_file = tf.extractfile("build-metadata.json")
+            if metadata_file is None:
+                return None
+            metadata = json.loads(metadata_file.read())
+    except (KeyError, tarfile.TarError, ValueError):
+        return None
+    return metadata.get("repository")  # type: ignore [no-any-return]
+
+
+def process_upload(
+    cfg: Config,
+    s3session: s3.S3ServiceResource,
+    path_str: str,
+    local_dir: str | pathlib.Path,
+    *,
+    signer: Signer | None = None,
+    finalizer: Finalizer | None = None,
+) -> TarballReport | None:
+    path = pathlib.Path(path_str)
+    if not path.is_file():
+        logger.info("File not found: %s", path)
+        return None
+    if path.suffix != ".tar":
+        logger.info("File is not a .tar archive: %s", path)
+        return None
+
+    logger.info("Looking at: %s", path)
+    started_at = time.monotonic()
+    report = TarballReport(
+        path=str(path),
+        repository=None,
+        status="failed",
+        lock_wait=0.0,
+        duration=0.0,
+        trace=Trace(),
+    )
+    trace_token = _current_trace.set(report["trace"])
+    tmp_mgr = tempfile.TemporaryDirectory(prefix="genrepo", dir=local_dir)
+    try:
+        with (
+            report["trace"].attach(s3session.meta.client),
+            tarfile.open(path, "r:") as tf,
+            tmp_mgr as temp_dir,
+        ):
+            metadata_file = tf.extractfile("build-metadata.json")
+            if metadata_file is None:
+                logger.info(
+                    "Tarball does not contain 'build-metadata.json': %s",
+                    path,
+                )
+                report["status"] = "skipped"
+                return report
+
+            metadata = json.loads(metadata_file.read())
+            repository = metadata.get("repository")
+            report["repository"] = repository
+
+            local_dir_path = pathlib.Path(local_dir)
+            temp_dir_path = pathlib.Path(temp_dir)
+            lock_path = local_dir_path / f"{repository}.lock"
+
+            tags = metadata.get("tags") or {}
+            tag_buckets = []
+
+            raw_tag_buckets = tags.get("buckets", "")
+            if raw_tag_buckets:
+                tag_buckets = [
+                    bucket.strip() for bucket in raw_tag_buckets.split(",")
+                ]
+
+            if not tag_buckets:
+                tag_buckets = [tags.get("bucket", "default")]
+
+            logger.info(f"Obtaining {lock_path}")
+            lock_started_at = time.monotonic()
+            with span("lock_wait"):
+                if finalizer is not None and repository in {"apt", "rpm"}:
+                    lock = finalizer.hold(lock_path).acquire()
+                else:
+                    lock = filelock.FileLock(lock_path, timeout=3600).acquire()
+            report["lock_wait"] = time.monotonic() - lock_started_at
+            with lock:
+                for target_bucket in tag_buckets:
+                    bucket = cfg["common"]["buckets"].get(target_bucket)
+                    if bucket is None:
+                        raise RuntimeError(
+                            "invalid target bucket in metadata: "
+                            f"{target_bucket!r}, configure it in "
+                            "genrepo.toml",
+                        )
+
+                    if repository == "generic":
+                        process_generic(
+                            cfg,
+                            s3session,
+                            tf,
+                            metadata,
+                            bucket,
+                            temp_dir_path,
+                            local_dir_path,
+                            signer=signer,
+                            finalizer=finalizer,
+                        )
+                    elif repository == "apt":
+                        process_apt(
+                            cfg,
+                            s3session,
+                            tf,
+                            metadata,
+                            bucket,
+                            temp_dir_path,
+                            local_dir_path,
+                            finalizer=finalizer,
+                        )
+                    elif repository == "rpm":
+                        process_rpm(
+                            cfg,
+                            s3session,
+                            tf,
+                            metadata,
+                            bucket,
+                            temp_dir_path,
+                            local_dir_path,
+                            signer=signer,
+                            finalizer=finalizer,
+                        )
+
+        logger.info("Successfully processed: %s", path)
+        report["status"] = "ok"
+        return report
+    finally:
+        report["duration"] = time.monotonic() - started_at
+        _current_trace.reset(trace_token)
+        trace_dir = cfg["common"].get("trace_dir")
+        if trace_dir:
+            write_trace(pathlib.Path(trace_dir), report)
+        with contextlib.suppress(PermissionError):
+            os.unlink(path)
+
+
+def log_timing_report(reports: list[TarballReport]) -> None:
+    if not reports:
+        return
+
+    logger.info("Processed %d tarball(s):", len(reports))
+    for report in sorted(reports, key=lambda r: r["duration"], reverse=True):
+        logger.info(
+            "  %8.1fs (lock wait %6.1fs)  %-7s  %-7s  %s",
+            report["duration"],
+            report["lock_wait"],
+            report["repository"] or "-",
+            report["status"],
+            report["path"],
+        )
+
+
+def write_trace(trace_dir: pathlib.Path, report: TarballReport) -> None:
+    trace = report["trace"]
+    started_at = datetime.datetime.fromtimestamp(
+        trace.started_at,
+        datetime.UTC,
+    )
+    data = {
+        "path": report["path"],
+        "repository": report["repository"],
+        "status": report["status"],
+        "started_at": started_at.isoformat(),
+        "duration": report["duration"],
+        "lock_wait": report["lock_wait"],
+        "counters": dict(sorted(trace.counters.items())),
+        "spans": trace.spans,
+    }
+    name = pathlib.Path(report["path"]).stem
+    trace_path = trace_dir / f"{name}.{started_at:%Y%m%dT%H%M%S}.json"
+    try:
+        trace_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_write(trace_path) as f:
+            f.write(json.dumps(data, indent=2).encode())
+    except OSError as e:
+        logger.error("cannot write trace %s: %s", trace_path, e)
+
+
+def write_metrics(
+    path: pathlib.Path,
+    reports: list[TarballReport],
+    duration: float,
+) -> None:
+    """Write a summary of *reports* to *path* as OpenMetrics text."""
+    tarballs: collections.Counter[tuple[str, str]] = collections.Counter()
+    tarball_count: collections.Counter[str] = collections.Counter()
+    tarball_seconds: collections.defaultdict[str, float]
+    tarball_seconds = collections.defaultdict(float)
+    lock_wait: collections.defaultdict[str, float]
+    lock_wait = collections.defaultdict(float)
+    span_count: collections.Counter[str] = collections.Counter()
+    span_seconds: collections.defaultdict[str, float]
+    span_seconds = collections.defaultdict(float)
+    counters: collections.Counter[str] = collections.Counter()
+
+    for report in reports:
+        repository = report["repository"] or ""
+        tarballs[repository, report["status"]] += 1
+        tarball_count[repository] += 1
+        tarball_seconds[repository] += report["duration"]
+        lock_wait[repository] += report["lock_wait"]
+        counters.update(report["trace"].counters)
+        for record in report["trace"].spans:
+            span_count[record["name"]] += 1
+            span_seconds[record["name"]] += record["duration"] or 0.0
+
+    lines = [
+        "# TYPE genrepo_run_duration_seconds gauge",
+        "# HELP genrepo_run_duration_seconds Time spent on all uploads.",
+        f"genrepo_run_duration_seconds {duration}",
+        "# TYPE genrepo_tarballs counter",
+        "# HELP genrepo_tarballs Processed tarballs.",
+    ]
+    for (repository, status), n in sorted(tarballs.items()):
+        labels = _metric_labels(repository=repository, status=status)
+        lines.append(f"genrepo_tarballs_total{labels} {n}")
+
+    lines += [
+        "# TYPE genrepo_tarball_duration_seconds summary",
+        "# HELP genrepo_tarball_duration_seconds Time spent per tarball.",
+    ]
+    for repository, n in sorted(tarball_count.items()):
+        labels = _metric_labels(repository=repository)
+        seconds = tarball_seconds[repository]
+        lines += [
+            f"genrepo_tarball_duration_seconds_count{labels} {n}",
+            f"genrepo_tarball_duration_seconds_sum{labels} {seconds}",
+        ]
+
+    lines += [
+        "# TYPE genrepo_lock_wait_seconds counter",
+        "# HELP genrepo_lock_wait_seconds Time spent waiting for locks.",
+    ]
+    for repository, seconds in sorted(lock_wait.items()):
+        labels = _metric_labels(repository=repository)
+        lines.append(f"genrepo_lock_wait_seconds_total{labels} {seconds}")
+
+    lines += [
+        "# TYPE genrepo_span_duration_seconds summary",
+        "# HELP genrepo_span_duration_seconds Time spent per traced call.",
+    ]
+    for name, n in sorted(span_count.items()):
+        labels = _metric_labels(span=name)
+        lines += [
+            f"genrepo_span_duration_seconds_count{labels} {n}",
+            f"genrepo_span_duration_seconds_sum{labels} {span_seconds[name]}",
+        ]
+
+    lines += [
+        "# TYPE genrepo_s3_requests counter",
+        "# HELP genrepo_s3_requests S3 API requests.",
+    ]
+    for name, n in sorted(counters.items()):
+        if name.startswith("s3.requests."):
+            labels = _metric_labels(operation=name[len("s3.requests.") :])
+            lines.append(f"genrepo_s3_requests_total{labels} {n}")
+
+    lines += [
+        "# TYPE genrepo_s3_bytes counter",
+        "# HELP genrepo_s3_bytes Bytes transferred to and from S3.",
+    ]
+    for direction in ("sent", "received"):
+        labels = _metric_labels(direction=direction)
+        n = counters[f"s3.bytes_{direction}"]
+        lines.append(f"genrepo_s3_bytes_total{labels} {n}")
+
+    lines += [
+        "# TYPE genrepo_subprocess_calls counter",
+        "# HELP genrepo_subprocess_calls External commands run.",
+        f"genrepo_subprocess_calls_total {counters['subprocess.calls']}",
+        "# EOF",
+    ]
+
+    try:
+        with atomic_write(path) as f:
+            f.write("".join(f"{line}\n" for line in lines).encode())
+    except OSError as e:
+        logger.error("cannot write metrics %s: %s", path, e)
+
+
+def _metric_labels(**labels: str) -> str:
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in labels.items()
+    )
+    return f"{{{pairs}}}"
+
+
+class RoutingRules:
+    """The routing rules of a bucket website configuration.
+
+    Rules are indexed by their KeyPrefixEquals condition, so redirects
+    can be added or updated without scanning the whole rule list, and
+    changes are tracked so that unchanged configurations need not be
+    written back.
+    """
+
+    def __init__(
+        self,
+        rules: list[s3types.RoutingRuleTypeDef] | None,
+    ) -> None:
+        self._original = copy.deepcopy(rules or [])
+        self.rules = copy.deepcopy(self._original)
+        self._by_prefix: dict[str, s3types.RoutingRuleTypeDef] = {}
+        for rule in self.rules:
+            prefix = (rule.get("Condition") or {}).get("KeyPrefixEquals")
+            if prefix is not None:
+                self._by_prefix.setdefault(prefix, rule)
+
+    @property
+    def changed(self) -> bool:
+        return self.rules != self._original
+
+    def redirect(self, src_key: str, tgt_key: str) -> None:
+        rule = self._by_prefix.get(src_key)
+        if rule is not None:
+            redirect = rule.setdefault("Redirect", {})
+            redirect["ReplaceKeyPrefixWith"] = tgt_key
+            redirect["HttpRedirectCode"] = "307"
+        else:
+            rule = {
+                "Condition": {
+                    "KeyPrefixEquals": src_key,
+                },
+                "Redirect": {
+                    "HttpRedirectCode": "307",
+                    "Protocol": "https",
+                    "HostName": "packages.geldata.com",
+                    "ReplaceKeyPrefixWith": tgt_key,
+                },
+            }
+            self.rules.append(rule)
+            self._by_prefix[src_key] = rule
+
+    def check_limit(self) -> None:
+        """Make sure the rules fit into a website configuration.
+
+        If there are too many, rules that can never match because an
+        earlier rule catches all of their keys are dropped.  If that is
+        not enough, raise an error that names the key prefixes with the
+        most rules as candidates for consolidation.
+        """
+        if len(self.rules) <= MAX_ROUTING_RULES:
+            return
+
+        shadowed = self._find_shadowed()
+        if shadowed:
+            logger.info(
+                "dropping %d unreachable routing rule(s)",
+                len(shadowed),
+            )
+            self.rules = [
+                rule for i, rule in enumerate(self.rules) if i not in shadowed
+            ]
+            self._by_prefix = {
+                prefix: rule
+                for prefix, rule in self._by_prefix.items()
+                if any(rule is r for r in self.rules)
+            }
+            if len(self.rules) <= MAX_ROUTING_RULES:
+                return
+
+        dirs: collections.Counter[str] = collections.Counter()
+        for rule in self.rules:
+            prefix = (rule.get("Condition") or {}).get("KeyPrefixEquals")
+            if prefix:
+                dirs[prefix.rpartition("/")[0] + "/"] += 1
+        suggestions = ", ".join(
+            f"{d} ({n} rules)" for d, n in dirs.most_common(5)
+        )
+        raise RuntimeError(
+            f"bucket website configuration would need {len(self.rules)} "
+            f"routing rules, but S3 allows at most {MAX_ROUTING_RULES}; "
+            f"consider consolidating the rules under: {suggestions}",
+        )
 
+    def _find_shadowed(self) -> set[int]:
+        # S3 applies the first matching rule, so a rule whose key prefix
+        # starts with the key prefix of an earlier unconditional-prefix
+        # rule is never used.
+        shadowed = set()
+        catch_prefixes: list[str] = []
+        for i, rule in enumerate(self.rules):
+            condition = rule.get("Condition") or {}
+            prefix = condition.get("KeyPrefixEquals")
+            if prefix is None:
+                continue
+            if any(prefix.startswith(p) for p in catch_prefixes):
+                shadowed.add(i)
+            elif condition.keys() == {"KeyPrefixEquals"}:
+                catch_prefixes.append(prefix)
+        return shadowed
+
+
+@traced
 def process_generic(
     cfg: Config,
     s3session: s3.S3ServiceResource,
@@ -686,10 +3040,21 @@ def process_generic(
     bucket_name: str,
     temp_dir: pathlib.Path,
     local_dir: pathlib.Path,
+    *,
+    signer: Signer | None = None,
+    finalizer: Finalizer | None = None,
 ) -> None:
+    """Publish the artifacts of a generic upload tarball.
+
+    Unless a *finalizer* is given, outdated artifacts are removed and
+    the JSON indexes and bucket redirects are updated right away.  With
+    a *finalizer* that work is recorded in it to be done in bulk.
+    """
+    if signer is None:
+        signer = SubprocessSigner()
     bucket = s3session.Bucket(bucket_name)
     pkg_directories = set()
-    rrules = {}
+    rrules: dict[pathlib.Path, pathlib.Path] = {}
     basename = metadata["name"]
     slot = metadata.get("version_slot")
     slot_suf = f"-{slot}" if slot else ""
@@ -702,23 +3067,26 @@ def process_generic(
 
     staging_dir = temp_dir / pkg_dir
     os.makedirs(staging_dir)
+    uploads = UploadBatch(bucket)
+    added: dict[str, list[tuple[dict[str, Any], InstallRef]]] = {}
+    to_sign = []
 
     for member in tf.getmembers():
         if member.name in {".", "build-metadata.json"}:
             continue
 
         leaf = pathlib.Path(member.name)
-        tf.extract(member, staging_dir, filter="data")
+        digests = extract_with_digests(tf, member, staging_dir)
 
         desc = contents[member.name]
         ext = desc["suffix"]
-        asc_path = gpg_detach_sign(staging_dir / leaf)
-        sha256_path = sha256(staging_dir / leaf)
-        blake2b_path = blake2b(staging_dir / leaf)
+        to_sign.append(staging_dir / leaf)
+        asc_path = signature_path(staging_dir / leaf)
+        digest_paths = write_digest_files(staging_dir / leaf, digests)
         metadata_path = staging_dir / f"{leaf}.metadata.json"
 
         with open(metadata_path, "w") as f:
-            json.dump(metadata, f)
+            json.dump({**metadata, "digests": digests}, f)
 
         logger.info(f"metadata={metadata}")
         logger.info(f"target={target} leaf={leaf}")
@@ -728,11 +3096,27 @@ def process_generic(
 
         # Store the fully-qualified artifact to archive/
         archive_dir = ARCHIVE / pkg_dir
-        put(bucket, staging_dir / leaf, archive_dir, cache=True)
-        put(bucket, asc_path, archive_dir, cache=True)
-        put(bucket, sha256_path, archive_dir, cache=True)
-        put(bucket, blake2b_path, archive_dir, cache=True)
-        put(bucket, metadata_path, archive_dir, cache=True)
+        uploads.put(staging_dir / leaf, archive_dir, cache=True)
+        uploads.put(asc_path, archive_dir, cache=True)
+        for digest_path in digest_paths:
+            uploads.put(digest_path, archive_dir, cache=True)
+        uploads.put(metadata_path, archive_dir, cache=True)
+
+        verification: dict[str, str | int] = {
+            "size": (staging_dir / leaf).stat().st_size,
+        }
+        verification.update(digests)
+        added.setdefault(pkg_dir, []).append(
+            (
+                metadata,
+                InstallRef(
+                    ref=f"/{archive_dir / leaf}",
+                    type=desc["type"],
+                    encoding=desc.get("encoding"),
+                    verification=verification,
+                ),
+            ),
+        )
 
         links = metadata.get("publish_link_to_latest")
         if links and desc.get("encoding") == "identity":
@@ -751,23 +3135,20 @@ def process_generic(
                 # below for details.
                 target_dir = DIST / pkg_dir
                 dist_name = f"{link}{slot_suf}{ext}"
-                put(bucket, b"", target_dir, name=dist_name)
-
-                asc_name = f"{dist_name}.asc"
-                put(bucket, b"", target_dir, name=asc_name)
-
-                sha_name = f"{dist_name}.sha256"
-                put(bucket, b"", target_dir, name=sha_name)
-
-                sha_name = f"{dist_name}.blake2b"
-                put(bucket, b"", target_dir, name=sha_name)
+                # With a finalizer the redirects are only set up at the
+                # end, so the placeholders are put then too, or they
+                # would be served as empty files until then.
+                if finalizer is None:
+                    put_dist_placeholders(uploads, target_dir / dist_name)
 
                 rrules[target_dir / dist_name] = archive_dir / leaf
 
-    for pkg_dir in pkg_directories:
-        remove_old(bucket, ARCHIVE / pkg_dir, keep=1, channel="nightly")
-        make_generic_index(bucket, ARCHIVE, pkg_dir)
+    # Signatures are queued for upload above, but only need to exist by
+    # the time the batch is flushed.
+    signer.sign_many(to_sign)
 
+    website = None
+    routing_rules = None
     if rrules:
         # We can't use per-object redirects, because in that case S3
         # generates the `301 Moved Permanently` response, and, adding
@@ -780,58 +3161,282 @@ def process_generic(
         # one redirect rule to handle both the main artifact and its
         # accompanying signature and checksum files.
         #
-        # NOTE: Amazon S3 has a limitation of 50 routing rules per
-        #       website configuration.
+        # Amazon S3 has a limitation of 50 routing rules per website
+        # configuration, so check that before uploading anything.
         website = s3session.BucketWebsite(bucket_name)
-        existing_rrules = list(website.routing_rules)
+        routing_rules = RoutingRules(website.routing_rules)
+        if finalizer is not None:
+            # Redirects still pending from earlier tarballs count
+            # against the limit too.
+            for src, tgt in finalizer.rrules.get(bucket_name, {}).items():
+                routing_rules.redirect(str(src), str(tgt))
         for src, tgt in rrules.items():
-            src_key = str(src)
-            tgt_key = str(tgt)
-            for rule in existing_rrules:
-                condition = rule.get("Condition")
-                if not condition:
-                    continue
-                if condition.get("KeyPrefixEquals") == src_key:
-                    try:
-                        redirect = rule["Redirect"]
-                    except KeyError:
-                        redirect = rule["Redirect"] = {}
-
-                    redirect["ReplaceKeyPrefixWith"] = tgt_key
-                    redirect["HttpRedirectCode"] = "307"
-                    break
-            else:
-                existing_rrules.append(
-                    {
-                        "Condition": {
-                            "KeyPrefixEquals": src_key,
-                        },
-                        "Redirect": {
-                            "HttpRedirectCode": "307",
-                            "Protocol": "https",
-                            "HostName": "packages.geldata.com",
-                            "ReplaceKeyPrefixWith": tgt_key,
-                        },
-                    },
-                )
+            routing_rules.redirect(str(src), str(tgt))
+        routing_rules.check_limit()
 
-        website_config: s3types.WebsiteConfigurationTypeDef = {
-            "RoutingRules": existing_rrules,
-        }
+    uploads.flush()
+
+    if finalizer is not None:
+        finalizer.record(
+            bucket_name,
+            {pkg_dir: added.get(pkg_dir, []) for pkg_dir in pkg_directories},
+            rrules,
+        )
+        return
+
+    update_generic_indexes(
+        cfg,
+        bucket,
+        local_dir,
+        {pkg_dir: added.get(pkg_dir, []) for pkg_dir in pkg_directories},
+    )
+
+    if website is not None and routing_rules is not None:
+        update_website_routing_rules(website, routing_rules)
+
+
+def put_dist_placeholders(uploads: UploadBatch, path: pathlib.Path) -> None:
+    """Queue the empty dist/ objects that are redirected to archive/."""
+    for suffix in ("", ".asc", ".sha256", ".blake2b"):
+        uploads.put(b"", path.parent, name=f"{path.name}{suffix}")
+
+
+class Finalizer:
+    """Index, redirect and sync work deferred to the end of a listing.
+
+    process_generic() records the artifacts it added and the redirects
+    it wants per bucket, and finalize() then collects outdated artifacts
+    and updates every touched JSON index and website configuration just
+    once, however many tarballs contributed to them.  The dist/
+    placeholders of the redirects are put only after that.  Likewise,
+    process_apt() and process_rpm() only stage packages in the local
+    repository and leave pushing it to the bucket to finalize().  Local
+    repositories are ahead of their buckets until then, so their locks
+    are held until finalize() as well.
+    """
+
+    def __init__(self) -> None:
+        self.added: dict[
+            str,
+            dict[str, list[tuple[dict[str, Any], InstallRef]]],
+        ] = {}
+        self.rrules: dict[str, dict[pathlib.Path, pathlib.Path]] = {}
+        self.syncs: dict[tuple[pathlib.Path, str], Callable[[], None]] = {}
+        self.locks: dict[pathlib.Path, filelock.FileLock] = {}
+        # S3 clients the deferred syncs use, for tracing them.
+        self.clients: list[Any] = []
+
+    def record(
+        self,
+        bucket_name: str,
+        added: dict[str, list[tuple[dict[str, Any], InstallRef]]],
+        rrules: dict[pathlib.Path, pathlib.Path],
+    ) -> None:
+        bucket_added = self.added.setdefault(bucket_name, {})
+        for pkg_dir, pkg_added in added.items():
+            bucket_added.setdefault(pkg_dir, []).extend(pkg_added)
+        if rrules:
+            self.rrules.setdefault(bucket_name, {}).update(rrules)
+
+    def hold(self, lock_path: pathlib.Path) -> filelock.FileLock:
+        """Return the lock at *lock_path*, acquired until finalize()."""
+        lock = self.locks.get(lock_path)
+        if lock is None:
+            # Not thread-local, as the lock is taken in whichever worker
+            # processes the repository but released by finalize().
+            lock = filelock.FileLock(
+                lock_path,
+                timeout=3600,
+                thread_local=False,
+            )
+            lock.acquire()
+            self.locks[lock_path] = lock
+        return lock
+
+    def defer_sync(
+        self,
+        local_path: pathlib.Path,
+        bucket: s3.Bucket,
+        sync: Callable[[], None],
+    ) -> None:
+        """Have *sync* push *local_path* to *bucket* in finalize()."""
+        self.syncs.setdefault((local_path, bucket.name), sync)
+        client = bucket.meta.client
+        if all(c is not client for c in self.clients):
+            self.clients.append(client)
+
+    def is_pending(self, local_path: pathlib.Path, bucket_name: str) -> bool:
+        return (local_path, bucket_name) in self.syncs
+
+    def sync(
+        self,
+        local_path: pathlib.Path | None = None,
+        *,
+        keep: str | None = None,
+    ) -> None:
+        """Run the pending syncs of everything under *local_path*.
+
+        Syncs to the bucket named *keep* are left pending.  A failed sync
+        does not stop the others; the first error is raised after all of
+        them have run.
+        """
+        errors: list[Exception] = []
+        for key in list(self.syncs):
+            path, bucket_name = key
+            if bucket_name == keep:
+                continue
+            if local_path is not None and not path.is_relative_to(local_path):
+                continue
+            try:
+                self.syncs.pop(key)()
+            except Exception as e:
+                logger.exception("Sync of %s to %s failed", path, bucket_name)
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+
+    def finalize(
+        self,
+        cfg: Config,
+        s3session: s3.S3ServiceResource,
+        local_dir: pathlib.Path,
+    ) -> None:
+        try:
+            self.sync()
+        finally:
+            locks, self.locks = self.locks, {}
+            for lock in locks.values():
+                lock.release()
+            self._finalize_generic(cfg, s3session, local_dir)
+
+    def _finalize_generic(
+        self,
+        cfg: Config,
+        s3session: s3.S3ServiceResource,
+        local_dir: pathlib.Path,
+    ) -> None:
+        added, self.added = self.added, {}
+        rrules, self.rrules = self.rrules, {}
+        if not added:
+            return
+
+        # Buckets are independent, so one failing does not hold up the
+        # others; the first error is raised once all are done.
+        errors: list[Exception] = []
+        lock_path = local_dir / "generic.lock"
+        logger.info(f"Obtaining {lock_path}")
+        with filelock.FileLock(lock_path, timeout=3600):
+            for bucket_name, bucket_added in added.items():
+                try:
+                    update_generic_indexes(
+                        cfg,
+                        s3session.Bucket(bucket_name),
+                        local_dir,
+                        bucket_added,
+                    )
+                except Exception as e:
+                    logger.exception(
+                        "Updating generic indexes in %s failed",
+                        bucket_name,
+                    )
+                    errors.append(e)
+
+            for bucket_name, bucket_rrules in rrules.items():
+                try:
+                    website = s3session.BucketWebsite(bucket_name)
+                    routing_rules = RoutingRules(website.routing_rules)
+                    for src, tgt in bucket_rrules.items():
+                        routing_rules.redirect(str(src), str(tgt))
+                    routing_rules.check_limit()
+                    update_website_routing_rules(website, routing_rules)
+
+                    # Put the placeholders only once they are redirected.
+                    uploads = UploadBatch(s3session.Bucket(bucket_name))
+                    for src in bucket_rrules:
+                        put_dist_placeholders(uploads, src)
+                    uploads.flush()
+                except Exception as e:
+                    logger.exception(
+                        "Updating redirects in %s failed",
+                        bucket_name,
+                    )
+                    errors.append(e)
 
-        if website.error_document is not None:
-            website_config["ErrorDocument"] = website.error_document
+        if errors:
+            raise errors[0]
 
-        if website.index_document is not None:
-            website_config["IndexDocument"] = website.index_document
 
-        if website.redirect_all_requests_to is not None:
-            website_config["RedirectAllRequestsTo"] = (
-                website.redirect_all_requests_to
+def update_generic_indexes(
+    cfg: Config,
+    bucket: s3.Bucket,
+    local_dir: pathlib.Path,
+    added: dict[str, list[tuple[dict[str, Any], InstallRef]]],
+) -> None:
+    """Remove outdated artifacts and update the indexes of *added*."""
+    metadata_cache = MetadataCache.for_bucket(local_dir, bucket.name)
+    index_compression = cfg["common"].get("index_compression")
+    for pkg_dir, pkg_added in added.items():
+        removed = remove_old(
+            bucket,
+            ARCHIVE / pkg_dir,
+            keep=1,
+            channel="nightly",
+            metadata_cache=metadata_cache,
+            dry_run=cfg["generic"].get("gc_dry_run", False),
+        )
+        if cfg["generic"].get("full_rebuild"):
+            make_generic_index(
+                bucket,
+                ARCHIVE,
+                pkg_dir,
+                metadata_cache=metadata_cache,
+                compression=index_compression,
+            )
+        else:
+            update_generic_index(
+                bucket,
+                ARCHIVE,
+                pkg_dir,
+                added=pkg_added,
+                removed=removed,
+                metadata_cache=metadata_cache,
+                compression=index_compression,
             )
+    metadata_cache.save()
+    remove_stale_index_copies(
+        bucket,
+        ARCHIVE,
+        list(added),
+        compression=index_compression,
+    )
+
 
-        logger.info("updating bucket website config:")
-        website.put(WebsiteConfiguration=website_config)
+def update_website_routing_rules(
+    website: s3.BucketWebsite,
+    routing_rules: RoutingRules,
+) -> None:
+    if not routing_rules.changed:
+        logger.info("bucket website routing rules are up to date")
+        return
+
+    website_config: s3types.WebsiteConfigurationTypeDef = {
+        "RoutingRules": routing_rules.rules,
+    }
+
+    if website.error_document is not None:
+        website_config["ErrorDocument"] = website.error_document
+
+    if website.index_document is not None:
+        website_config["IndexDocument"] = website.index_document
+
+    if website.redirect_all_requests_to is not None:
+        website_config["RedirectAllRequestsTo"] = (
+            website.redirect_all_requests_to
+        )
+
+    logger.info("updating bucket website config:")
+    website.put(WebsiteConfiguration=website_config)
 
 
 def generate_reprepro_distributions(
@@ -857,6 +3462,7 @@ def generate_reprepro_distributions(
     return "\n".join(dists)
 
 
+@traced
 def process_apt(
     cfg: Config,
     s3session: s3.S3ServiceResource,
@@ -865,7 +3471,14 @@ def process_apt(
     bucket_name: str,
     temp_dir: pathlib.Path,
     local_dir: pathlib.Path,
+    *,
+    finalizer: Finalizer | None = None,
 ) -> None:
+    """Add the packages in *tf* to the apt repository in *bucket_name*.
+
+    With a *finalizer*, the packages are only added to the local copy
+    of the repository and publishing it is left to the finalizer.
+    """
     bucket = s3session.Bucket(bucket_name)
     changes = None
     incoming_dir = temp_dir / "incoming"
@@ -880,6 +3493,7 @@ def process_apt(
     local_apt_dir.mkdir(parents=True, exist_ok=True)
     index_dir = local_apt_dir / ".jsonindexes"
     index_dir.mkdir(exist_ok=True)
+    manifest = SyncManifest.open(local_apt_dir / ".s3sync.json")
 
     with open(reprepro_conf / "incoming", "w") as f:
         dists = " ".join(d["codename"] for d in cfg["apt"]["distributions"])
@@ -910,19 +3524,55 @@ def process_apt(
                 return
             changes = fn
 
-    for sub in [".jsonindexes", "db", "dists"]:
-        sync_to_local(
-            bucket,
-            pathlib.Path("/apt") / sub,
-            local_apt_dir / sub,
-            exact_timestamps=True,
-        )
+    # The local repository is shared by all buckets, so changes still
+    # pending for another bucket have to be published first.  Changes
+    # pending for this one mean the local repository is already ahead of
+    # the bucket and must not be synced from it.
+    pending = False
+    if finalizer is not None:
+        finalizer.sync(local_apt_dir, keep=bucket_name)
+        pending = finalizer.is_pending(local_apt_dir, bucket_name)
+
+    pool_generation = None
+    if not pending:
+        for sub in [".jsonindexes", "db", "dists"]:
+            sync_to_local(
+                bucket,
+                pathlib.Path("/apt") / sub,
+                local_apt_dir / sub,
+                exact_timestamps=True,
+                manifest=manifest,
+            )
 
-    sync_to_local(
-        bucket,
-        pathlib.Path("/apt") / "pool",
-        local_apt_dir / "pool",
-    )
+        # In mirror mode the local pool is trusted as long as the
+        # generation marker in the bucket matches the one we recorded
+        # when we last pushed the pool, i.e. nobody else has touched it
+        # since.
+        pool_generation_file = local_apt_dir / ".pool-generation"
+        if cfg["apt"].get("mirror_pool", False):
+            pool_generation = read_generation(bucket, APT_POOL_GENERATION)
+
+        if (
+            pool_generation is not None
+            and pool_generation_file.exists()
+            and pool_generation_file.read_text().strip() == pool_generation
+        ):
+            logger.info(
+                "process_apt: local pool mirror is current (generation %s)",
+                pool_generation,
+            )
+        else:
+            sync_to_local(
+                bucket,
+                pathlib.Path("/apt") / "pool",
+                local_apt_dir / "pool",
+                manifest=manifest,
+            )
+        manifest.save()
+
+        # The local pool is about to diverge from the bucket, so it must
+        # not be trusted again until it has been pushed back successfully.
+        pool_generation_file.unlink(missing_ok=True)
 
     subprocess_run(
         [
@@ -940,161 +3590,138 @@ def process_apt(
         check=True,
     )
 
-    result = subprocess_run(
-        [
-            "reprepro",
-            f"--confdir={reprepro_conf!s}",
-            f"--basedir={local_apt_dir!s}",
-            f"--logdir={reprepro_logs!s}",
-            "dumpreferences",
-        ],
-        text=True,
-        check=True,
-        stdout=subprocess.PIPE,
-        stderr=None,
+    publish = functools.partial(
+        publish_apt,
+        cfg,
+        bucket,
+        local_apt_dir,
+        pool_generation=pool_generation,
     )
+    if finalizer is None:
+        publish()
+    elif not pending:
+        finalizer.defer_sync(local_apt_dir, bucket, publish)
 
-    repo_dists = set()
-    for line in result.stdout.split("\n"):
-        if not line.strip():
-            continue
-
-        dist, _, _ = line.partition("|")
-        repo_dists.add(dist)
 
-    list_format = (
-        r"\0".join(
-            (
-                r"${$architecture}",
-                r"${$component}",
-                r"${package}",
-                r"${version}",
-                r"${$fullfilename}",
-                r"${Installed-Size}",
-                r"${Metapkg-Metadata}",
-            ),
-        )
-        + r"\n"
-    )
+@traced
+def publish_apt(
+    cfg: Config,
+    bucket: s3.Bucket,
+    local_apt_dir: pathlib.Path,
+    *,
+    pool_generation: str | None,
+) -> None:
+    """Regenerate the JSON indexes of an apt repository and sync it to S3.
 
-    existing: dict[str, dict[tuple[str, str, str], Package]] = {}
-    packages: dict[str, dict[tuple[str, str, str], Package]] = {}
+    *pool_generation* is the generation marker of the bucket pool the
+    local pool was mirrored from, if any.
+    """
+    index_dir = local_apt_dir / ".jsonindexes"
+    manifest = SyncManifest.open(local_apt_dir / ".s3sync.json")
+    catver_cache = CatverCache.open(local_apt_dir / ".catver-cache.json")
+    existing: dict[str, PackageIndex] = {}
+    packages: dict[str, PackageIndex] = {}
+
+    for (
+        dist,
+        arch,
+        component,
+        pkgname,
+        pkgver,
+        pkgfile,
+        size,
+        pkgmetadata_json,
+    ) in list_apt_packages(cfg, local_apt_dir):
+        if component != "main" and not dist.endswith(component):
+            index_dist = f"{dist}.{component}"
+        else:
+            index_dist = dist
 
-    for dist in repo_dists:
-        result = subprocess_run(
-            [
-                "reprepro",
-                f"--confdir={reprepro_conf!s}",
-                f"--basedir={local_apt_dir!s}",
-                f"--logdir={reprepro_logs!s}",
-                f"--list-format={list_format}",
-                "list",
-                dist,
-            ],
-            text=True,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=None,
-        )
+        prev_dist_packages = existing.get(index_dist)
+        if prev_dist_packages is None:
+            idxfile = index_dir / f"{index_dist}.json"
+            existing[index_dist] = prev_dist_packages = load_index(idxfile)
 
-        for line in result.stdout.split("\n"):
-            if not line.strip():
-                continue
+        dist_packages = packages.get(index_dist)
+        if dist_packages is None:
+            packages[index_dist] = dist_packages = {}
 
-            (
-                arch,
-                component,
-                pkgname,
-                pkgver,
-                pkgfile,
-                size,
-                pkgmetadata_json,
-            ) = line.split("\0")
-
-            if component != "main" and not dist.endswith(component):
-                index_dist = f"{dist}.{component}"
-            else:
-                index_dist = dist
+        if arch == "amd64":
+            arch = "x86_64"
 
-            prev_dist_packages = existing.get(index_dist)
-            if prev_dist_packages is None:
-                idxfile = index_dir / f"{index_dist}.json"
-                existing[index_dist] = prev_dist_packages = load_index(idxfile)
+        is_metapackage = bool(size) and int(size) < 20
 
-            dist_packages = packages.get(index_dist)
-            if dist_packages is None:
-                packages[index_dist] = dist_packages = {}
+        relver, _, revver = pkgver.rpartition("-")
 
-            if arch == "amd64":
-                arch = "x86_64"
+        m = slot_regexp.match(pkgname)
+        if not m:
+            logger.error("cannot parse package name: %s", pkgname)
+            basename = pkgname
+            slot = None
+        else:
+            basename = m.group(1)
+            slot = m.group(2)
 
-            is_metapackage = int(size) < 20
+        if pkgmetadata_json:
+            pkgmetadata = json.loads(pkgmetadata_json)
+            if is_metapackage:
+                pkgmetadata["name"] = basename
+            parsed_ver = pkgmetadata["version_details"]
+        else:
+            parsed_ver = parse_version(relver)
+            pkgmetadata = {
+                "name": basename,
+                "version": relver,
+                "version_slot": slot,
+                "version_details": parsed_ver,
+                "architecture": arch,
+                "revision": revver,
+            }
 
-            relver, _, revver = pkgver.rpartition("-")
+        version_key = format_version_key(parsed_ver, revver)
+        ver_metadata = pkgmetadata["version_details"]["metadata"]
+        index_key = (pkgmetadata["name"], version_key, arch)
 
-            m = slot_regexp.match(pkgname)
-            if not m:
-                logger.error("cannot parse package name: %s", pkgname)
-                basename = pkgname
-                slot = None
-            else:
-                basename = m.group(1)
-                slot = m.group(2)
-
-            if pkgmetadata_json:
-                pkgmetadata = json.loads(pkgmetadata_json)
-                if is_metapackage:
-                    pkgmetadata["name"] = basename
-                parsed_ver = pkgmetadata["version_details"]
-            else:
-                parsed_ver = parse_version(relver)
-                pkgmetadata = {
-                    "name": basename,
-                    "version": relver,
-                    "version_slot": slot,
-                    "version_details": parsed_ver,
-                    "architecture": arch,
-                    "revision": revver,
-                }
-
-            version_key = format_version_key(parsed_ver, revver)
-            ver_metadata = pkgmetadata["version_details"]["metadata"]
-            index_key = (pkgmetadata["name"], version_key, arch)
-
-            if index_key in prev_dist_packages:
-                dist_packages[index_key] = prev_dist_packages[index_key]
-                dist_packages[index_key]["architecture"] = arch
-            else:
-                if basename == "edgedb-server" and not ver_metadata.get(
-                    "catalog_version",
-                ):
-                    if not pathlib.Path(pkgfile).exists():
-                        logger.error(f"package file does not exist: {pkgfile}")
+        if index_key in prev_dist_packages:
+            dist_packages[index_key] = prev_dist_packages[index_key]
+            dist_packages[index_key].architecture = arch
+        else:
+            if (
+                basename == "edgedb-server"
+                and arch != "source"
+                and not ver_metadata.get("catalog_version")
+            ):
+                if not pkgfile.exists():
+                    logger.error(f"package file does not exist: {pkgfile}")
+                else:
+                    catver = catver_cache.get_catver(pkgfile)
+                    if catver is None:
+                        logger.error(
+                            f"cannot extract catver from {pkgfile}",
+                        )
                     else:
-                        catver = extract_catver_from_deb(pkgfile)
-                        if catver is None:
-                            logger.error(
-                                f"cannot extract catver from {pkgfile}",
-                            )
-                        else:
-                            ver_metadata["catalog_version"] = str(catver)
-                            logger.info(
-                                f"extracted catver {catver} from {pkgfile}",
-                            )
-
-                installref = InstallRef(
-                    ref=f"{pkgname}={relver}-{revver}",
-                    type=None,
-                    encoding=None,
-                    verification={},
-                )
+                        ver_metadata["catalog_version"] = str(catver)
+                        logger.info(
+                            f"extracted catver {catver} from {pkgfile}",
+                        )
+
+            installref = InstallRef(
+                ref=f"{pkgname}={relver}-{revver}",
+                type=None,
+                encoding=None,
+                verification={},
+            )
 
-                append_artifact(dist_packages, pkgmetadata, installref)
+            append_artifact(dist_packages, pkgmetadata, installref)
 
     for index_dist, dist_packages in packages.items():
-        idxfile = index_dir / f"{index_dist}.json"
-        with open(idxfile, "w") as f:
-            json.dump({"packages": list(dist_packages.values())}, f)
+        write_index(
+            index_dir / f"{index_dist}.json",
+            dist_packages,
+            compression=cfg["common"].get("index_compression"),
+        )
+
+    catver_cache.save()
 
     for sub in [".jsonindexes", "db", "dists"]:
         sync_to_s3(
@@ -1102,14 +3729,137 @@ def process_apt(
             local_apt_dir / sub,
             pathlib.Path("/apt") / sub,
             cache_control="no-store, no-cache, private, max-age=0",
+            content_encodings=(
+                INDEX_CONTENT_ENCODINGS if sub == ".jsonindexes" else None
+            ),
+            manifest=manifest,
         )
 
-    sync_to_s3(
+    pool_changes = sync_to_s3(
         bucket,
         local_apt_dir / "pool",
         pathlib.Path("/apt") / "pool",
         cache_control="public, no-transform, max-age=315360000",
+        manifest=manifest,
     )
+    manifest.save()
+
+    if cfg["apt"].get("mirror_pool", False):
+        if pool_changes or pool_generation is None:
+            pool_generation = uuid.uuid4().hex
+            put(
+                bucket,
+                pool_generation.encode(),
+                APT_POOL_GENERATION.parent,
+                name=APT_POOL_GENERATION.name,
+                content_type="text/plain",
+            )
+        pool_generation_file = local_apt_dir / ".pool-generation"
+        pool_generation_file.write_text(f"{pool_generation}\n")
+
+
+def list_apt_packages(
+    cfg: Config,
+    local_apt_dir: pathlib.Path,
+) -> Iterator[tuple[str, str, str, str, str, pathlib.Path, str, str]]:
+    """List all packages in the local repository by reading its indexes.
+
+    Walks the ``Packages`` and ``Sources`` files reprepro exports for
+    every configured distribution, which gives the same information as
+    ``reprepro list`` for all distributions at once and without spawning
+    any processes.  Yields ``(dist, arch, component, package, version,
+    path, installed_size, metapkg_metadata)`` tuples, where source
+    packages have the ``source`` architecture, the path of their .dsc
+    and no installed size.
+    """
+    for distro in cfg["apt"]["distributions"]:
+        dist = distro["codename"]
+        dist_dir = local_apt_dir / "dists" / dist
+        for pkgs_file in sorted(dist_dir.glob("*/binary-*/Packages")):
+            component = pkgs_file.parent.parent.name
+            arch = pkgs_file.parent.name.removeprefix("binary-")
+            with open(pkgs_file) as f:
+                for para in deb822.Packages.iter_paragraphs(
+                    f,
+                    use_apt_pkg=False,
+                ):
+                    yield (
+                        dist,
+                        arch,
+                        component,
+                        para["Package"],
+                        para["Version"],
+                        local_apt_dir / para["Filename"],
+                        para.get("Installed-Size", ""),
+                        para.get("Metapkg-Metadata", ""),
+                    )
+
+        for srcs_file in sorted(dist_dir.glob("*/source/Sources")):
+            component = srcs_file.parent.parent.name
+            with open(srcs_file) as f:
+                for src in deb822.Sources.iter_paragraphs(
+                    f,
+                    use_apt_pkg=False,
+                ):
+                    dsc = next(
+                        entry["name"]
+                        for entry in src["Files"]
+                        if entry["name"].endswith(".dsc")
+                    )
+                    yield (
+                        dist,
+                        "source",
+                        component,
+                        src["Package"],
+                        src["Version"],
+                        local_apt_dir / src["Directory"] / dsc,
+                        "",
+                        src.get("Metapkg-Metadata", ""),
+                    )
+
+
+class CatverCache(PersistentCache):
+    """Catalog versions extracted from legacy edgedb-server .deb files.
+
+    Entries are keyed by .deb file name and size and failed extractions
+    are remembered too, so that no package is ever unpacked twice.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        super().__init__(path)
+        self._entries: dict[str, int | None] = {}
+        self._dirty = False
+
+        if path.exists():
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)["entries"]
+            except ValueError:
+                logger.warning("ignoring corrupt catver cache: %s", path)
+            self._update_mtime()
+
+    def get_catver(self, path: pathlib.Path) -> int | None:
+        key = f"{path.name}:{path.stat().st_size}"
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+
+        catver = extract_catver_from_deb(str(path))
+        self._entries[key] = catver
+        self._dirty = True
+        return catver
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+
+        tmp_path = self._path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": self._entries}, f)
+        os.replace(tmp_path, self._path)
+        self._update_mtime()
+        self._dirty = False
 
 
 def extract_catver_from_deb(path: str) -> int | None:
@@ -1119,22 +3869,264 @@ def extract_catver_from_deb(path: str) -> int | None:
         + "/server/defines.py"
     )
 
-    with tempfile.TemporaryDirectory() as _td:
-        td = pathlib.Path(_td)
-        subprocess_run(["ar", "x", path, "data.tar.xz"], cwd=_td)
-        with tarfile.open(td / "data.tar.xz", "r:xz") as tarf:
-            for member in tarf.getmembers():
-                if fnmatch.fnmatch(member.path, defines_pattern):
-                    df = tarf.extractfile(member)
-                    if df is not None:
-                        for lb in df.readlines():
-                            line = lb.decode()
-                            if line.startswith(cv_prefix):
-                                return int(line[len(cv_prefix) :])
+    with open(path, "rb") as f:
+        for name, member in iter_ar_members(f):
+            if not name.startswith("data.tar"):
+                continue
+
+            with open_tar_stream(member, name) as tarf:
+                for tarinfo in tarf:
+                    if fnmatch.fnmatch(tarinfo.path, defines_pattern):
+                        df = tarf.extractfile(tarinfo)
+                        if df is not None:
+                            for lb in df.readlines():
+                                line = lb.decode()
+                                if line.startswith(cv_prefix):
+                                    return int(line[len(cv_prefix) :])
+            break
 
     return None
 
 
+class _ArMemberReader(io.RawIOBase):
+    def __init__(self, f: IO[bytes], size: int) -> None:
+        self._f = f
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        n = min(len(b), self.remaining)
+        if n == 0:
+            return 0
+        data = self._f.read(n)
+        b[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def iter_ar_members(f: IO[bytes]) -> Iterator[tuple[str, IO[bytes]]]:
+    """Iterate over the members of an ar(1) archive, such as a .deb.
+
+    Members are yielded as ``(name, file)`` pairs, where *file* reads
+    the member's data directly from *f*.  Whatever a caller leaves
+    unread is skipped over when the iteration advances.
+    """
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError("not an ar archive")
+
+    while True:
+        header = f.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != AR_HEADER_SIZE or header[58:] != b"`\n":
+            raise ValueError("corrupt ar archive")
+
+        name = header[:16].decode().rstrip().removesuffix("/")
+        size = int(header[48:58])
+        member = _ArMemberReader(f, size)
+        yield name, io.BufferedReader(member)
+        # Members are aligned on even offsets.
+        f.seek(member.remaining + size % 2, os.SEEK_CUR)
+
+
+def open_tar_stream(f: IO[bytes], name: str) -> tarfile.TarFile:
+    """Open a possibly compressed tar stream for sequential reading.
+
+    The compression is inferred from the suffix of *name*, as with the
+    ``data.tar.*`` and ``control.tar.*`` members of a .deb.
+    """
+    suffix = pathlib.PurePath(name).suffix
+    if suffix == ".zst":
+        zstd_reader = zstandard.ZstdDecompressor().stream_reader(f)
+        return tarfile.open(fileobj=zstd_reader, mode="r|")
+    elif suffix == ".xz":
+        return tarfile.open(fileobj=f, mode="r|xz")
+    elif suffix == ".gz":
+        return tarfile.open(fileobj=f, mode="r|gz")
+    elif suffix == ".bz2":
+        return tarfile.open(fileobj=f, mode="r|bz2")
+    else:
+        return tarfile.open(fileobj=f, mode="r|")
+
+
+REPOMD_NS = {"repo": "http://linux.duke.edu/metadata/repo"}
+
+# (name, version, release, arch, installed size, changelog, location)
+RPMPackageRow = tuple[str, str, str, str, int, str | None, str]
+
+
+def list_rpm_packages(
+    repo_dir: pathlib.Path,
+    temp_dir: pathlib.Path,
+) -> list[RPMPackageRow]:
+    """List all packages in an RPM repository from its sqlite metadata.
+
+    Reads the ``primary_db`` and ``other_db`` databases referenced by
+    ``repodata/repomd.xml`` (as generated by ``createrepo_c --database``)
+    and returns ``(name, version, release, arch, installed_size,
+    changelog, location)`` tuples, where *changelog* is the text of the
+    newest changelog entry of the package, if any.  Repositories
+    generated without ``--database`` are listed by reading the headers
+    of their package files instead.
+    """
+    repomd = ElementTree.parse(repo_dir / "repodata" / "repomd.xml")
+    dbs = {}
+    for data in repomd.iterfind("repo:data", REPOMD_NS):
+        location = data.find("repo:location", REPOMD_NS)
+        if location is not None:
+            dbs[data.get("type")] = repo_dir / location.attrib["href"]
+
+    if "primary_db" not in dbs or "other_db" not in dbs:
+        logger.warning(
+            "%s has no sqlite metadata, reading package files instead",
+            repo_dir,
+        )
+        return query_repo_rpm_files(repo_dir)
+
+    primary_db = decompress_repo_db(dbs["primary_db"], temp_dir)
+    other_db = decompress_repo_db(dbs["other_db"], temp_dir)
+
+    with contextlib.closing(sqlite3.connect(primary_db)) as db:
+        db.execute("ATTACH DATABASE ? AS other", (str(other_db),))
+        rows = db.execute(
+            """
+            SELECT
+                p.name, p.version, p.release, p.arch, p.size_installed,
+                (SELECT c.changelog
+                 FROM other.packages AS o
+                 JOIN other.changelog AS c ON c.pkgKey = o.pkgKey
+                 WHERE o.pkgId = p.pkgId
+                 ORDER BY c.date DESC
+                 LIMIT 1),
+                p.location_href
+            FROM packages AS p
+            """,
+        ).fetchall()
+
+    return rows
+
+
+def query_repo_rpm_files(repo_dir: pathlib.Path) -> list[RPMPackageRow]:
+    """Read the headers of all RPM files under *repo_dir*."""
+    rpms = sorted(p.relative_to(repo_dir) for p in repo_dir.rglob("*.rpm"))
+    return query_rpm_files(rpms, repo_dir)
+
+
+def query_rpm_files(
+    rpms: list[pathlib.Path],
+    cwd: pathlib.Path,
+) -> list[RPMPackageRow]:
+    """Read the headers of RPM files with a single ``rpm -qp`` call.
+
+    Returns the same tuples as :func:`list_rpm_packages`, with paths
+    as given in *rpms* as locations.
+    """
+    if not rpms:
+        return []
+
+    fields = ("NAME", "VERSION", "RELEASE", "ARCH", "SIZE", "CHANGELOGTEXT")
+    qf = "\x1f".join(f"%{{{field}}}" for field in fields) + "\x1e"
+    result = subprocess_run(
+        ["rpm", "-qp", f"--qf={qf}", *rpms],
+        cwd=cwd,
+        text=True,
+        capture_output=True,
+        check=True,
+    )
+
+    rows = []
+    records = result.stdout.split("\x1e")[:-1]
+    for rpm, record in zip(rpms, records, strict=True):
+        name, version, release, arch, size, changelog = record.split("\x1f")
+        rows.append(
+            (
+                name,
+                version,
+                release,
+                arch,
+                int(size),
+                changelog if changelog != "(none)" else None,
+                str(rpm),
+            ),
+        )
+
+    return rows
+
+
+def resign_rpms(
+    rpms: list[pathlib.Path],
+    source_dir: pathlib.Path,
+    target_dir: pathlib.Path,
+    *,
+    jobs: int = SIGN_JOBS,
+) -> None:
+    """Re-sign RPM files concurrently and move them to *target_dir*.
+
+    Signed files are renamed into place, which only falls back to
+    copying when the two directories are on different filesystems.
+    """
+
+    def _resign(rpm: pathlib.Path) -> None:
+        start = time.monotonic()
+        subprocess_run(
+            [
+                "rpm",
+                "--resign",
+                rpm,
+            ],
+            input=b"\n",
+            cwd=source_dir,
+            check=True,
+        )
+        logger.info(
+            f"process_rpm: signed {rpm} in {time.monotonic() - start:.1f}s",
+        )
+        shutil.move(source_dir / rpm, target_dir / rpm)
+
+    logger.info(f"process_rpm: re-signing {len(rpms)} package(s)")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        # Run each job in a copy of the current context, so that its
+        # subprocess shows up in the trace of the tarball.
+        futures = [
+            pool.submit(contextvars.copy_context().run, _resign, rpm)
+            for rpm in rpms
+        ]
+        for future in futures:
+            future.result()
+
+
+def decompress_repo_db(path: pathlib.Path, temp_dir: pathlib.Path) -> str:
+    """Decompress a repodata sqlite database into *temp_dir*."""
+    target = temp_dir / path.name.removesuffix(path.suffix)
+    with (
+        open(path, "rb") as f,
+        open_decompressed(f, path.suffix) as src,
+        open(target, "wb") as out,
+    ):
+        shutil.copyfileobj(src, out)
+    return str(target)
+
+
+def open_decompressed(
+    f: IO[bytes],
+    suffix: str,
+) -> IO[bytes] | io.BufferedIOBase:
+    """Wrap *f* to decompress it according to a file name *suffix*."""
+    if suffix == ".zst":
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    elif suffix == ".bz2":
+        return bz2.BZ2File(f)
+    elif suffix == ".gz":
+        return gzip.GzipFile(fileobj=f)
+    elif suffix == ".xz":
+        return lzma.LZMAFile(f)
+    else:
+        return f
+
+
+@traced
 def process_rpm(
     cfg: Config,
     s3session: s3.S3ServiceResource,
@@ -1143,7 +4135,17 @@ def process_rpm(
     bucket_name: str,
     temp_dir: pathlib.Path,
     local_dir: pathlib.Path,
+    *,
+    signer: Signer | None = None,
+    finalizer: Finalizer | None = None,
 ) -> None:
+    """Add the packages in *tf* to the rpm repository in *bucket_name*.
+
+    With a *finalizer*, the packages are only added to the local copy
+    of the repository and syncing it to S3 is left to the finalizer.
+    """
+    if signer is None:
+        signer = SubprocessSigner()
     bucket = s3session.Bucket(bucket_name)
     incoming_dir = temp_dir / "incoming"
     incoming_dir.mkdir()
@@ -1151,6 +4153,7 @@ def process_rpm(
     local_rpm_dir.mkdir(parents=True, exist_ok=True)
     index_dir = local_rpm_dir / ".jsonindexes"
     index_dir.mkdir(exist_ok=True)
+    manifest = SyncManifest.open(local_rpm_dir / ".s3sync.json")
 
     rpms = []
     for member in tf.getmembers():
@@ -1172,136 +4175,66 @@ def process_rpm(
     local_dist_dir = local_rpm_dir / dist_dir
     local_dist_dir.mkdir(parents=True, exist_ok=True)
 
-    sync_to_local(
-        bucket,
-        pathlib.Path("/rpm") / dist_dir,
-        local_dist_dir,
-        exact_timestamps=True,
-    )
-
-    sync_to_local(
-        bucket,
-        pathlib.Path("/rpm") / ".jsonindexes",
-        index_dir,
-        exact_timestamps=True,
-    )
+    # See process_apt() on syncing local repositories shared by buckets.
+    if finalizer is not None:
+        finalizer.sync(local_rpm_dir, keep=bucket_name)
+
+    for remote_dir, local_path in [
+        (pathlib.Path("/rpm") / dist_dir, local_dist_dir),
+        (pathlib.Path("/rpm") / ".jsonindexes", index_dir),
+    ]:
+        if finalizer is None or not finalizer.is_pending(
+            local_path,
+            bucket_name,
+        ):
+            sync_to_local(
+                bucket,
+                remote_dir,
+                local_path,
+                exact_timestamps=True,
+                manifest=manifest,
+            )
+    manifest.save()
 
     repomd = local_dist_dir / "repodata" / "repomd.xml"
-    if not repomd.exists():
-        subprocess_run(
-            [
-                "createrepo_c",
-                "--database",
-                local_dist_dir,
-            ],
-            cwd=incoming_dir,
-            check=True,
-        )
-
-    for rpm in rpms:
-        logger.info(f"process_rpm: running `rpm --resign {rpm}`")
-        subprocess_run(
-            [
-                "rpm",
-                "--resign",
-                rpm,
-            ],
-            input=b"\n",
-            cwd=incoming_dir,
-            check=True,
-        )
-
-        shutil.copy(incoming_dir / rpm, local_dist_dir / rpm)
-
-    logger.info("process_rpm: running `createrepo_c --update`")
-    subprocess_run(
-        [
-            "createrepo_c",
-            "--update",
-            local_dist_dir,
-        ],
-        check=True,
-    )
+    if repomd.exists():
+        logger.info("process_rpm: reading repository metadata")
+        rows = list_rpm_packages(local_dist_dir, temp_dir)
+    else:
+        # Without metadata the pkglist below must still name the packages
+        # already in the repository, or createrepo_c would drop them.
+        logger.info("process_rpm: no repository metadata, reading packages")
+        rows = query_repo_rpm_files(local_dist_dir)
+    repo_packages = {row[-1]: row for row in rows}
+    existing_files = set(repo_packages)
 
-    logger.info("process_rpm: signing repomd.xml")
-    gpg_detach_sign(repomd)
+    logger.info("process_rpm: reading incoming packages")
+    for row in query_rpm_files(rpms, incoming_dir):
+        repo_packages[row[-1]] = row
 
     logger.info("process_rpm: loading index")
     idxfile = index_dir / f"{idx}.json"
     packages = load_index(idxfile)
 
-    logger.info("process_rpm: fetching changelogs")
-    changelogs = subprocess_run(
-        [
-            "dnf",
-            f"--repofrompath={dist},{local_dist_dir}",
-            f"--repoid={dist}",
-            f"--releasever={dist}",
-            "repoquery",
-            "--changelogs",
-            "-q",
-            "*",
-        ],
-        text=True,
-        capture_output=True,
-        check=True,
-    )
-
-    lines_seen = 0
-    lines: list[str] = []
-    package: str | None = None
-    metadatas = {}
-
-    for line in changelogs.stdout.splitlines():
-        m = re.match(r"^Changelog for (?P<nevra>.*)$", line)
-        if m:
-            lines_seen = 0
-            if lines and package:
-                possibly_metadata_json = "\n".join(lines)
-                try:
-                    pkgmetadata = json.loads(possibly_metadata_json)
-                except ValueError:
-                    pkgmetadata = None
-                else:
-                    metadatas[package] = pkgmetadata
-                lines.clear()
-            package = m.group("nevra")
-            assert package
-        elif lines_seen >= 2 and package:
-            if lines_seen == 2:
-                lines.append(line.lstrip(" -"))
-            else:
-                lines.append(line)
-        lines_seen += 1
-
-    slot_index: dict[str, list[tuple[str, str, str, str]]] = {}
-
-    result = subprocess_run(
-        [
-            "dnf",
-            f"--repofrompath={dist},{local_dist_dir}",
-            f"--repoid={dist}",
-            f"--releasever={dist}",
-            "repoquery",
-            "--qf=%{name}|%{version}|%{release}|%{arch}|%{installsize}",
-            "-q",
-            "*",
-        ],
-        text=True,
-        capture_output=True,
-        check=True,
-    )
+    slot_index: dict[str, list[tuple[PackageRecord, str, str]]] = {}
 
     logger.info("process_rpm: updating index")
-    for line in result.stdout.splitlines():
-        if not line.strip():
-            continue
-
-        pkgname, pkgver, release, arch, size = line.split("|")
+    for (
+        pkgname,
+        pkgver,
+        release,
+        arch,
+        size,
+        changelog,
+        href,
+    ) in repo_packages.values():
         nevra = f"{pkgname}-{pkgver}-{release}.{arch}"
-        pkgmetadata = metadatas.get(nevra)
+        pkgmetadata = None
+        if changelog:
+            with contextlib.suppress(ValueError):
+                pkgmetadata = json.loads(changelog.lstrip(" -"))
 
-        is_metapackage = int(size) == 0
+        is_metapackage = size == 0
 
         m = slot_regexp.match(pkgname)
         if not m:
@@ -1330,19 +4263,6 @@ def process_rpm(
             pkgmetadata["revision"],
         )
 
-        slot_name = pkgmetadata["name"]
-        if pkgmetadata.get("version_slot"):
-            slot_name += f".{pkgmetadata['version_slot']}"
-        slot_name += f".{pkgmetadata['architecture']}"
-        slot_index.setdefault(slot_name, []).append(
-            (
-                version_key,
-                pkgmetadata["name"],
-                nevra,
-                pkgmetadata["architecture"],
-            ),
-        )
-
         installref = InstallRef(
             ref=nevra,
             type=None,
@@ -1352,51 +4272,102 @@ def process_rpm(
 
         append_artifact(packages, pkgmetadata, installref)
 
-    need_db_update = False
+        slot_name = pkgmetadata["name"]
+        if pkgmetadata.get("version_slot"):
+            slot_name += f".{pkgmetadata['version_slot']}"
+        slot_name += f".{pkgmetadata['architecture']}"
+        index_key = (
+            pkgmetadata["name"],
+            version_key,
+            pkgmetadata["architecture"],
+        )
+        slot_index.setdefault(slot_name, []).append(
+            (packages[index_key], nevra, href),
+        )
+
     if channel == "nightly":
         logger.info("process_rpm: collecting garbage")
-        comp = functools.cmp_to_key(debian_support.version_compare)
         for _slot_name, versions in slot_index.items():
             sorted_versions = sorted(
                 versions,
-                key=lambda v: comp(v[0]),
+                key=lambda v: v[0].sort_key,
                 reverse=True,
             )
 
-            for ver_key, name, ver_nevra, arch in sorted_versions[3:]:
+            for pkg, ver_nevra, href in sorted_versions[3:]:
                 logger.info(f"process_rpm: deleting outdated {ver_nevra}")
-                packages.pop((name, ver_key, arch), None)
-                outdated = local_dist_dir / f"{ver_nevra}.rpm"
-                if outdated.exists():
-                    os.unlink(outdated)
-                need_db_update = True
-
-    if need_db_update:
-        logger.info("process_rpm: running `createrepo_c --update` (again)")
-        subprocess_run(
-            [
-                "createrepo_c",
-                "--update",
-                local_dist_dir,
-            ],
-            check=True,
-        )
+                packages.pop(
+                    (pkg.basename, pkg.version_key, pkg.architecture),
+                    None,
+                )
+                del repo_packages[href]
 
-    with open(idxfile, "w") as f:
-        json.dump({"packages": list(packages.values())}, f)
+    for href in existing_files - repo_packages.keys():
+        (local_dist_dir / href).unlink(missing_ok=True)
 
-    sync_to_s3(
+    resign_rpms(
+        [rpm for rpm in rpms if str(rpm) in repo_packages],
+        incoming_dir,
+        local_dist_dir,
+        jobs=cfg["rpm"].get("sign_jobs", SIGN_JOBS),
+    )
+
+    pkglist = temp_dir / "pkglist"
+    pkglist.write_text("".join(f"{href}\n" for href in sorted(repo_packages)))
+
+    logger.info("process_rpm: running `createrepo_c --update`")
+    subprocess_run(
+        [
+            "createrepo_c",
+            "--update",
+            "--database",
+            f"--pkglist={pkglist}",
+            local_dist_dir,
+        ],
+        check=True,
+    )
+
+    logger.info("process_rpm: signing repomd.xml")
+    signer.sign(repomd)
+
+    write_index(
+        idxfile,
+        packages,
+        compression=cfg["common"].get("index_compression"),
+    )
+
+    publish_dist = functools.partial(
+        sync_rpm_dist_to_s3,
         bucket,
-        local_dist_dir / "repodata",
-        pathlib.Path("/rpm") / dist_dir / "repodata",
-        cache_control="no-store, no-cache, private, max-age=0",
+        local_rpm_dir,
+        dist_dir,
     )
+    publish_indexes = functools.partial(
+        sync_rpm_indexes_to_s3,
+        bucket,
+        local_rpm_dir,
+    )
+    if finalizer is None:
+        publish_dist()
+        publish_indexes()
+    else:
+        finalizer.defer_sync(local_dist_dir, bucket, publish_dist)
+        finalizer.defer_sync(index_dir, bucket, publish_indexes)
 
+
+def sync_rpm_dist_to_s3(
+    bucket: s3.Bucket,
+    local_rpm_dir: pathlib.Path,
+    dist_dir: pathlib.Path,
+) -> None:
+    local_dist_dir = local_rpm_dir / dist_dir
+    manifest = SyncManifest.open(local_rpm_dir / ".s3sync.json")
     sync_to_s3(
         bucket,
-        index_dir,
-        pathlib.Path("/rpm") / ".jsonindexes",
+        local_dist_dir / "repodata",
+        pathlib.Path("/rpm") / dist_dir / "repodata",
         cache_control="no-store, no-cache, private, max-age=0",
+        manifest=manifest,
     )
 
     sync_to_s3(
@@ -1406,7 +4377,25 @@ def process_rpm(
         exclude="*",
         include="*.rpm",
         cache_control="public, no-transform, max-age=315360000",
+        manifest=manifest,
+    )
+    manifest.save()
+
+
+def sync_rpm_indexes_to_s3(
+    bucket: s3.Bucket,
+    local_rpm_dir: pathlib.Path,
+) -> None:
+    manifest = SyncManifest.open(local_rpm_dir / ".s3sync.json")
+    sync_to_s3(
+        bucket,
+        local_rpm_dir / ".jsonindexes",
+        pathlib.Path("/rpm") / ".jsonindexes",
+        cache_control="no-store, no-cache, private, max-age=0",
+        content_encodings=INDEX_CONTENT_ENCODINGS,
+        manifest=manifest,
     )
+    manifest.save()
 
 
 if __name__ == "__main__":
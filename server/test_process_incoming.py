@@ -0,0 +1,147 @@
+"""Checks of the compact package index records and their sort keys."""
+
+from __future__ import annotations
+from typing import Any
+
+import functools
+import json
+import random
+import string
+
+import pytest
+import semver
+
+from debian import debian_support
+
+import process_incoming
+
+
+PAIRS = 10000
+
+
+def random_debian_version(rng: random.Random) -> str:
+    def part(alphabet: str) -> str:
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6)))
+
+    upstream = rng.choice(string.digits) + part("0123456789abz.+~")
+    if rng.random() < 0.5:
+        upstream += "-" + part("0123456789abz.+~")
+    version = upstream
+    if rng.random() < 0.3:
+        version = f"{rng.randint(0, 3)}:{version}"
+    if rng.random() < 0.7:
+        version += "-" + part("0123456789abz.+~")
+    return version
+
+
+def random_release(rng: random.Random) -> process_incoming.Version:
+    return process_incoming.Version(
+        major=rng.randint(0, 3),
+        minor=rng.choice([None, 0, 1, 2, 10]),
+        patch=rng.choice([None, 0, 1, 2, 10]),
+        prerelease=[
+            process_incoming.Prerelease(
+                phase=rng.choice(["alpha", "beta", "dev", "rc"]),
+                number=rng.randint(0, 12),
+            )
+            for _ in range(rng.choice([0, 0, 1, 1, 2]))
+        ],
+        metadata={},
+    )
+
+
+def to_semver(ver: process_incoming.Version) -> semver.Version:
+    return semver.Version(
+        ver["major"],
+        ver["minor"] or 0,
+        ver["patch"] or 0,
+        ".".join(f"{p['phase']}.{p['number']}" for p in ver["prerelease"])
+        or None,
+    )
+
+
+def cmp(a: Any, b: Any) -> int:
+    return int(a > b) - int(a < b)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_version_sort_key_matches_version_compare(seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(PAIRS):
+        a = random_debian_version(rng)
+        b = random_debian_version(rng)
+        expected = cmp(debian_support.version_compare(a, b), 0)
+        actual = cmp(
+            process_incoming.version_sort_key(a),
+            process_incoming.version_sort_key(b),
+        )
+        assert actual == expected, (a, b)
+
+
+def test_version_sort_key_sorts_like_version_compare() -> None:
+    rng = random.Random(42)
+    versions = [random_debian_version(rng) for _ in range(2000)]
+    expected = sorted(
+        versions,
+        key=functools.cmp_to_key(debian_support.version_compare),
+    )
+    actual = sorted(versions, key=process_incoming.version_sort_key)
+    assert [debian_support.Version(v) for v in actual] == [
+        debian_support.Version(v) for v in expected
+    ]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_release_sort_key_matches_semver(seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(PAIRS):
+        a = random_release(rng)
+        b = random_release(rng)
+        expected = to_semver(a).compare(to_semver(b))
+        actual = cmp(
+            process_incoming.release_sort_key(a),
+            process_incoming.release_sort_key(b),
+        )
+        assert actual == expected, (a, b)
+
+
+def test_index_entries_round_trip() -> None:
+    version = process_incoming.parse_version("1.0")
+    current = {
+        "basename": "gel-server",
+        "name": "gel-server-1",
+        "slot": "1",
+        "version": "1.0",
+        "version_details": version,
+        "version_key": "1.0.0",
+        "revision": "1",
+        "build_date": "2023-12-14T21:30:16+00:00",
+        "tags": {},
+        "architecture": "x86_64",
+        "installref": "/a.tar",
+        "installrefs": [],
+        "extension": "postgis",
+    }
+    legacy = {
+        "name": "gel-server-1",
+        "basename": "gel-server",
+        "version": "1.0",
+        "version_details": version,
+        "version_key": "1.0.0",
+        "architecture": "x86_64",
+        "installref": "/a.tar",
+    }
+    for entry in (current, legacy):
+        record = process_incoming.PackageRecord.from_json(entry)
+        assert json.dumps(record.to_json()) == json.dumps(entry)
+
+    record = process_incoming.PackageRecord.from_json(legacy)
+    record.installrefs.append(
+        process_incoming.InstallRef(
+            ref="/b.tar",
+            type=None,
+            encoding=None,
+            verification={},
+        ),
+    )
+    assert list(record.to_json()) == [*legacy, "installrefs"]